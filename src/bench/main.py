@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "server"
+
+aparser = argparse.ArgumentParser(description="Killer server load test")
+aparser.add_argument("-e", "--endpoint", type=str, default="http://127.0.0.1:5000", help="Server base URL")
+aparser.add_argument("-n", "--hosts", type=str, default="100", help="Simulated hosts, comma separated runs: 100,1000,10000")
+aparser.add_argument("-d", "--duration", type=float, default=20, help="Ping phase duration per run, seconds")
+aparser.add_argument("-p", "--ping-interval", type=float, default=1, help="Ping interval of every simulated host")
+aparser.add_argument("-c", "--connections", type=int, default=500, help="Max open connections")
+aparser.add_argument("--watch", action="store_true", help="Hosts hold act=wait long-poll instead of only pinging")
+aparser.add_argument("--no-kill", action="store_true", help="Skip kill propagation measurement")
+aparser.add_argument("--login", type=str, default="admin")
+aparser.add_argument("--password", type=str, default="bench")
+aparser.add_argument("--spawn", choices=("flask", "asyncio"), default=None, help="Start a fresh local server for every run")
+aparser.add_argument("--port", type=int, default=5055, help="Port of the spawned server")
+aparser.add_argument("-o", "--output", type=str, default=None, help="Write results as JSON here (default: stdout)")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(latencies, errors, elapsed):
+    """Сводка по одному act: задержки в мс"""
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+class Spawned:
+    """Локальный сервер во временной папке"""
+
+    def __init__(self, mode, port, login, password):
+        self.dir = tempfile.TemporaryDirectory(prefix="killer-bench-")
+        d = Path(self.dir.name)
+        config = {
+            "server": {"host": "127.0.0.1", "port": port, "mode": mode},
+            "auth": [{"login": login, "password": password}],
+            "delays": {"kill_first": 5, "kill_second": 5},
+            "log": {"stdout": {"enabled": True, "level": "WARNING"}, "file": {"enabled": False, "dir": str(d)}},
+            "storage": {"dir": str(d)},
+            "notify": {},
+        }
+        (d / "config.json").write_text(json.dumps(config), "utf-8")
+        self.proc = subprocess.Popen([sys.executable, "main.py", "-c", str(d / "config.json")], cwd=SERVER_DIR,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(15)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.dir.cleanup()
+
+
+class Fleet:
+    """N хостов, говорящих на протоколе /client так же, как src/client"""
+
+    def __init__(self, args, session, run_id, size):
+        self.args = args
+        self.session = session
+        self.client_url = args.endpoint + "/client"
+        self.size = size
+        self.run_id = run_id
+        self.latencies = {}  # act: [секунды]
+        self.errors = {}
+        self.killed_at = None  # Момент kill_all
+        self.seen = []  # Когда каждый хост увидел kill
+        self.stop = asyncio.Event()
+
+    async def api(self, act, **data):
+        data['act'] = act
+        t = time.perf_counter()
+        try:
+            async with self.session.post(self.client_url, json=data) as r:
+                body = await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError):
+            self.errors[act] = self.errors.get(act, 0) + 1
+            return {}
+        if act != "wait":
+            self.latencies.setdefault(act, []).append(time.perf_counter() - t)
+        if body.get("error") and body.get("code") != 3:
+            self.errors[act] = self.errors.get(act, 0) + 1
+        return body
+
+    def _check_kill(self, r, state):
+        if state['seen'] or self.killed_at is None:
+            return
+        if any(r.get("status") or ()):
+            state['seen'] = True
+            self.seen.append(time.perf_counter() - self.killed_at)
+
+    async def _watch(self, device_hash, state):
+        status = [False, False]
+        while not self.stop.is_set() and not state['seen']:
+            r = await self.api("wait", device_hash=device_hash, status=status)
+            if "status" not in r:
+                await asyncio.sleep(1)
+                continue
+            status = r['status']
+            self._check_kill(r, state)
+
+    async def host(self, i):
+        info = {"hostname": f"bench-{self.run_id}-{i}", "ips": [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"],
+                "macs": [f"02:00:00:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}"], "server": False}
+        await asyncio.sleep(self.args.ping_interval * i / self.size)  # Разносим старт
+        r = await self.api("register", device_hash=None, **info)
+        device_hash = r.get("device_hash")
+        if device_hash is None:
+            return
+        await self.api("update", device_hash=device_hash, **info)
+        state = {"seen": False}
+        watcher = asyncio.create_task(self._watch(device_hash, state)) if self.args.watch else None
+        while not self.stop.is_set():
+            r = await self.api("ping", device_hash=device_hash)
+            self._check_kill(r, state)
+            try:
+                await asyncio.wait_for(self.stop.wait(), self.args.ping_interval)
+            except asyncio.TimeoutError:
+                pass
+        if watcher is not None:
+            watcher.cancel()
+        await self.api("shutdown", device_hash=device_hash)
+
+
+async def admin_session(args):
+    session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))  # unsafe: куки для IP-адресов
+    async with session.post(args.endpoint + "/admin", data={"username": args.login, "password": args.password},
+                            allow_redirects=False) as r:
+        if "sid" not in r.cookies:
+            await session.close()
+            raise RuntimeError("Admin login failed")
+    return session
+
+
+async def wait_idle(admin, args, timeout=120):
+    """Ждем, пока прошлый kill закончится"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with admin.post(args.endpoint + "/admin/api/updates", json={"since": 0}) as r:
+            if not any((await r.json(content_type=None)).get("status", (True,))):
+                return
+        await asyncio.sleep(1)
+
+
+async def run(args, run_id, size):
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        admin = None if args.no_kill else await admin_session(args)
+        if admin is not None:
+            await wait_idle(admin, args)
+        fleet = Fleet(args, session, run_id, size)
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(fleet.host(i)) for i in range(size)]
+        await asyncio.sleep(args.duration)
+        ping_elapsed = time.perf_counter() - started
+        kill = None
+        if admin is not None:
+            fleet.killed_at = time.perf_counter()
+            async with admin.post(args.endpoint + "/admin/api/kill_all") as r:
+                await r.read()
+            # Ждем, пока все увидят kill (не дольше двух интервалов пинга + 10с)
+            deadline = time.monotonic() + args.ping_interval * 2 + 10
+            while len(fleet.seen) < size and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            kill = {
+                "seen": len(fleet.seen),
+                "p50_ms": round(percentile(fleet.seen, 50) * 1000, 2) if fleet.seen else None,
+                "p99_ms": round(percentile(fleet.seen, 99) * 1000, 2) if fleet.seen else None,
+                "last_ms": round(max(fleet.seen) * 1000, 2) if fleet.seen else None,
+            }
+            await admin.close()
+        fleet.stop.set()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    acts = {act: summary(values, fleet.errors.get(act, 0), ping_elapsed if act == "ping" else elapsed)
+            for act, values in fleet.latencies.items()}
+    return {"hosts": size, "duration": round(elapsed, 2), "watch": args.watch, "acts": acts, "kill": kill}
+
+
+async def wait_port(args, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with aiohttp.ClientSession() as s:
+                async with s.get(args.endpoint + "/admin") as r:
+                    await r.read()
+                    return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def main():
+    args = aparser.parse_args()
+    if args.spawn:
+        args.endpoint = f"http://127.0.0.1:{args.port}"
+    results = []
+    run_id = int(time.time())
+    for size in map(int, args.hosts.split(",")):
+        server = Spawned(args.spawn, args.port, args.login, args.password) if args.spawn else None
+        try:
+            if server is not None:
+                asyncio.run(wait_port(args))
+            print(f"Running {size} hosts...", file=sys.stderr)
+            results.append(asyncio.run(run(args, run_id, size)))
+        finally:
+            if server is not None:
+                server.stop()
+    out = json.dumps({"endpoint": args.endpoint, "server": args.spawn, "runs": results}, indent=4)
+    if args.output:
+        Path(args.output).write_text(out, "utf-8")
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,29 @@ import atexit
 import json
 import os
 import platform
+import random
 import socket
-import sys
+import threading
 import time
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 
+import pythoncom
 import requests
 import wmi
 
 # noinspection DuplicatedCode
-ENDPOINT = os.getenv("ENDPOINT", "http://192.168.250.54:5000/client")
+ENDPOINT = os.getenv("ENDPOINT", "http://192.168.250.54:5000/client")  # Можно несколько через запятую
 HASH_FILE = os.getenv("HASH_FILE", "device.hash")
+# Интерфейсы и интервалы с прошлого запуска, лежат рядом с device.hash
+CACHE_FILE = os.getenv("CACHE_FILE", os.path.join(os.path.dirname(HASH_FILE), "client.json"))
 LOG_FILE = os.getenv("LOG_FILE", "killer-client.txt")
 NOT_SERVER = os.getenv("NOT_SERVER", "0")
+STARTUP_JITTER = float(os.getenv("STARTUP_JITTER", "10"))  # Случайная задержка перед первым запросом, сек
+PING_JITTER = float(os.getenv("PING_JITTER", "0.1"))  # Разброс интервала пинга, если сервер не назначил время
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", "300"))  # Потолок паузы между повторами при ошибках, сек
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "3"))  # Ожидание TCP-соединения с сервером, сек
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "10"))  # Ожидание ответа сервера, сек
 
 server = True
 if NOT_SERVER == "1":
@@ -61,28 +70,79 @@ def shutdown(log_file=LOG_FILE):
 class Host(object):
     ping_interval = timedelta(seconds=0)
     update_interval = timedelta(seconds=0)
+    retry_after = 2  # Начальная пауза при ошибках; сервер присылает свою в update
 
     def __init__(self, endpoint, hash_file):
         self.run = False
 
-        self.endpoint = endpoint
+        self.endpoints = [e.strip() for e in endpoint.split(",") if e.strip()]
+        self.current = 0  # Индекс сервера, который сейчас отвечает
         self.hash_file = Path(hash_file)
+        self.cache_file = Path(CACHE_FILE)
         self.session = requests.Session()
 
         self.ips = []
         self.macs = []
-        self.hostname = None
-        self._update_params()
+        self.ifaces = None  # None - еще не знаем ни из кэша, ни из WMI
+        self.hostname = socket.gethostname()
+        self.scanned = None  # Результат фонового перечисления WMI
+        self.scan_done = threading.Event()
+        self.net_changed = threading.Event()  # WMI нашел не то, что было в кэше - пора отправить update
+        self.update_retry = None  # Таймер повтора неудачного update; больше одного не заводим
 
         self.last_update = None
         self.device_hash = None
+        self.failures = 0  # Ошибок подряд - для экспоненциальной паузы
 
-    def _update_params(self):
-        self.hostname = socket.gethostname()
-        ifaces = get_ip_mac_addresses()
+    def _set_ifaces(self, ifaces):
+        self.ifaces = ifaces
         self.ips = [ip for ip, _ in ifaces]
         self.macs = [mac for _, mac in ifaces]
 
+    def _update_params(self):
+        """Свежие интерфейсы для register/update; если их еще нет совсем - ждем WMI"""
+        self.hostname = socket.gethostname()
+        if self.ifaces is None:
+            self.scan_done.wait()
+        if self.scanned is not None:
+            self._set_ifaces(self.scanned)
+
+    def _scan(self):
+        """WMI на старом железе отвечает секундами, поэтому перечисляем адаптеры в фоне, уже после первого пинга"""
+        pythoncom.CoInitialize()  # WMI в отдельном потоке работает только после инициализации COM
+        try:
+            self.scanned = [tuple(iface) for iface in get_ip_mac_addresses()]
+        except Exception as e:
+            print("[WMI] Error: {}".format(e))
+        finally:
+            pythoncom.CoUninitialize()
+        if self.scanned is not None and self.scanned != self.ifaces:
+            if self.ifaces is not None:
+                print("Interfaces changed since last run")
+            self.net_changed.set()
+        self.scan_done.set()
+
+    def _load_cache(self):
+        if not self.cache_file.exists():
+            return
+        try:
+            with open(str(self.cache_file), "r") as f:
+                cache = json.load(f)
+            ifaces = [tuple(iface) for iface in cache['ifaces']]
+            ping_interval, update_interval = cache['ping_interval'], cache['update_interval']
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            print("Can't read cache {}: {}".format(self.cache_file, e))
+            return
+        self._set_ifaces(ifaces)
+        self.ping_interval = timedelta(seconds=ping_interval)
+        self.update_interval = timedelta(seconds=update_interval)
+        print("Using cached interfaces: {}".format(ifaces))
+
+    def _save_cache(self):
+        with open(str(self.cache_file), "w") as f:
+            json.dump({"ifaces": self.ifaces, "ping_interval": self.ping_interval.total_seconds(),
+                       "update_interval": self.update_interval.total_seconds()}, f)
+
     def _save_hash(self):
         if self.last_update is None or self.device_hash is None:
             print("Can't save hash: last_update or device_hash is None")
@@ -98,6 +158,11 @@ class Host(object):
         last_update, self.device_hash = d.split("::", 1)
         self.last_update = datetime.fromtimestamp(float(last_update), timezone.utc)
 
+    def _timeout(self):
+        """(connect, read) для requests: выключенный сервер не держит запрос дольше интервала пинга"""
+        limit = self.ping_interval.total_seconds() or REQUEST_TIMEOUT  # До первого update интервал неизвестен
+        return min(CONNECT_TIMEOUT, limit), min(REQUEST_TIMEOUT, limit)
+
     def api(self, act):
         j = {"act": act, "device_hash": self.device_hash}
         if act not in ('ping', 'exit'):
@@ -107,17 +172,43 @@ class Host(object):
                 "macs": self.macs,
                 "server": server
             })
-        try:
-            s = self.session.post(self.endpoint, json=json.dumps(j), headers={'Content-Type': 'application/json'}).json()
-        except requests.exceptions.RequestException as e:
-            print("[API] Error: {}".format(e))
-            if self.run:
-                return {}
-            sys.exit(1)
+        # Сервер недоступен или он резервный - сразу пробуем следующий
+        s = None
+        for _ in range(len(self.endpoints)):
+            current = self.current
+            try:
+                s = self.session.post(self.endpoints[current], json=json.dumps(j), timeout=self._timeout(),
+                                      headers={'Content-Type': 'application/json'}).json()
+            except requests.exceptions.RequestException as e:
+                print("[API] Error ({}): {}".format(self.endpoints[current], e))
+                s = None
+            if s is not None and s.get("code") != 5:
+                break
+            self.current = (current + 1) % len(self.endpoints)
+        if s is None:
+            return {}  # Ни один сервер не ответил - решает вызывающий, обычно повтором через _backoff
         if s.get("error"):
             print("[API] Error: {}".format(s))
         return s
 
+    def _backoff(self, r):
+        """Пауза после ошибки: подсказка сервера или экспонента от числа ошибок подряд, со случайным разбросом"""
+        self.failures += 1
+        if isinstance(r.get("retry_after"), (int, float)):
+            delay = r['retry_after']
+        else:
+            delay = min(self.retry_after * 2 ** (self.failures - 1), BACKOFF_MAX)
+        return random.uniform(delay / 2, delay)
+
+    def _next_ping(self, p):
+        """Когда пинговать снова: в назначенное сервером время, иначе через ping_interval с разбросом"""
+        if "status" not in p:
+            return self._backoff(p)
+        self.failures = 0
+        if isinstance(p.get("next_ping"), (int, float)):
+            return p['next_ping']
+        return self.ping_interval.total_seconds() * random.uniform(1 - PING_JITTER, 1 + PING_JITTER)
+
     def shutdown(self, reason="atexit"):
         self.api("shutdown")
         self.run = False
@@ -130,71 +221,120 @@ class Host(object):
         self._save_hash()
 
     def register(self):
+        """Регистрация; возвращает ответ сервера - без device_hash в нем надо повторить позже"""
         print("Registering...")
+        self._update_params()
         u = self.api("register")
         if u.get("device_hash"):
             self._new_hash(u['device_hash'])
             print(" - Registered with device hash: {}".format(self.device_hash))
         else:
             print(" - Failed to register")
-            sys.exit(1)
+        return u
 
     def update(self):
         print("Updating...")
+        self.net_changed.clear()
+        self._update_params()
         u = self.api("update")
-        _old = self.device_hash
-        if u.get("device_hash") != self.device_hash:
+        if "ping_interval" not in u:
+            if self.update_retry is None or not self.update_retry.is_alive():
+                # Повторим, изменения не теряем
+                self.update_retry = threading.Timer(self._backoff(u), self.net_changed.set)
+                self.update_retry.daemon = True
+                self.update_retry.start()
+            return
+        if u['device_hash'] != self.device_hash:
             print("Device hash changed. New: {}".format(u['device_hash']))
         else:
             print("Device hash not updated")
+        self._new_hash(u['device_hash'])
+        self._apply_settings(u)
+        self._save_cache()
+
+    def hello(self):
+        """Один запрос вместо register + ping + ping + update; None - сервер не умеет hello или не ответил"""
+        print("Hello...")
+        self._update_params()
+        u = self.api("hello")
+        if "ping_interval" not in u:
+            return None
+        if u['device_hash'] != self.device_hash:
+            print("Device hash changed. New: {}".format(u['device_hash']))
+        self._new_hash(u['device_hash'])
+        self._apply_settings(u)
+        self._save_cache()
+        self.run = True
+        print("Connected to server")
+        return u
+
+    def _apply_settings(self, u):
+        """Интервалы из ответа на update/hello"""
+        self.retry_after = u.get('retry_after', self.retry_after)
         _pi, _ui = u['ping_interval'], u['update_interval']
         if self.ping_interval.total_seconds() != _pi or self.update_interval.total_seconds() != _ui:
             self.ping_interval = timedelta(seconds=_pi)
             self.update_interval = timedelta(seconds=_ui)
             print("Intervals changed: ping={}; update={}".format(self.ping_interval, self.update_interval))
-        self.last_update = datetime.now(timezone.utc)
 
-    def _pre_start(self, i=0):
-        if i > 3:
-            print("Can't connect to server. Exiting...")
-            sys.exit(1)
-        if self.device_hash is None:
-            self.register()
-        else:
-            print("Using cashed hash: {}".format(self.device_hash))
-        p = self.api("ping")
-        if p.get("code") == 4:
-            self.device_hash = None
-            return self._pre_start(i+1)
-        if self.api("ping").get("message") == "pong":
-            print("Connected to server")
-            self.run = True
+    def _pre_start(self):
+        """Регистрация и первый пинг. При массовом включении сервер может еще не подняться или отвечать 500 -
+        ждем паузу из _backoff (retry_after сервера или экспонента со случайным разбросом), а не выходим"""
+        while True:
+            if self.device_hash is None:
+                p = self.register()
+            else:
+                print("Using cashed hash: {}".format(self.device_hash))
+                p = {"device_hash": self.device_hash}
+            if p.get("device_hash"):
+                p = self.api("ping")
+                if "status" in p:
+                    self.failures = 0
+                    print("Connected to server")
+                    self.run = True
+                    return
+                if p.get("code") == 4:
+                    self.device_hash = None  # Сервер нас не знает - зарегистрируемся заново
+            time.sleep(self._backoff(p))
+
+    def _handle_status(self, status):
+        kill_first, kill_second = status
+        if kill_first:
+            if not server:
+                print("Received kill_first request. Shutting down...")
+                shutdown(LOG_FILE)
+            else:
+                print("Received kill_first request, but client registered as server. Ignoring...")
+        if kill_second:
+            print("Received kill_second request. Shutting down...")
+            shutdown(LOG_FILE)
 
     def start(self):
         print("Mode: {};".format("server" if server else "client"))
         self._read_hash()
-        self._pre_start()
-        self.update()
+        self._load_cache()
+        threading.Thread(target=self._scan, daemon=True).start()
+        # После включения питания все машины стартуют разом - расходимся, чтобы не прийти на сервер толпой
+        time.sleep(random.uniform(0, STARTUP_JITTER))
+        hello = self.hello() if self.device_hash is not None else None
+        if hello is None:
+            self._pre_start()
+            if not self.ping_interval:
+                self.update()  # Интервалов нет в кэше - без update не знаем, как часто пинговать
+        else:
+            self._handle_status(hello['status'])
+            self.net_changed.wait(self._next_ping(hello))  # hello уже был пингом
         while self.run:
-            if datetime.now(timezone.utc) - self.update_interval > self.last_update:
+            if self.net_changed.is_set() or datetime.now(timezone.utc) - self.update_interval > self.last_update:
                 self.update()
             p = self.api("ping")
             if p.get("code") == 4:
                 print('wtf')
                 self._pre_start()
 
-            kill_first, kill_second = p['status']
-            if kill_first:
-                if not server:
-                    print("Received kill_first request. Shutting down...")
-                    shutdown(LOG_FILE)
-                else:
-                    print("Received kill_first request, but client registered as server. Ignoring...")
-            if kill_second:
-                print("Received kill_second request. Shutting down...")
-                shutdown(LOG_FILE)
-
-            time.sleep(self.ping_interval.total_seconds())
+            if "status" in p:
+                self._handle_status(p['status'])
+            self.net_changed.wait(self._next_ping(p))  # WMI нашел изменения - отправим update, не дожидаясь пинга
 
 
 if __name__ == '__main__':
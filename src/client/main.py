@@ -1,20 +1,61 @@
 import atexit
+import hashlib
+import hmac
 import os
 import platform
+import random
 import socket
-import sys
+import struct
+import threading
 import time
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from urllib.parse import urlparse
 
 import psutil
 import requests
 
+try:
+    import msgpack
+except ImportError:  # Без msgpack клиент говорит с сервером в JSON
+    msgpack = None
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+except ImportError:  # Без cryptography уведомления соседей не проверить - LAN не слушаем
+    Ed25519PublicKey = None
+
 # noinspection DuplicatedCode
-ENDPOINT = os.getenv("ENDPOINT", "http://192.168.250.54:5000/client")
+ENDPOINT = os.getenv("ENDPOINT", "http://192.168.250.54:5000/client")  # Можно несколько через запятую
 HASH_FILE = os.getenv("HASH_FILE", "device.hash")
 LOG_FILE = os.getenv("LOG_FILE", "killer-client.txt")
 NOT_SERVER = os.getenv("NOT_SERVER", "0")
+STARTUP_JITTER = float(os.getenv("STARTUP_JITTER", "10"))  # Случайная задержка перед первым запросом, сек
+PING_JITTER = float(os.getenv("PING_JITTER", "0.1"))  # Разброс интервала пинга, если сервер не назначил время
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", "300"))  # Потолок паузы между повторами при ошибках, сек
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "2"))  # Ожидание ответа на UDP-пинг, сек
+LAN_BROADCAST = os.getenv("LAN_BROADCAST", "255.255.255.255")  # Куда пересылать уведомления о kill
+LAN_REPEAT = int(os.getenv("LAN_REPEAT", "3"))  # Сколько раз слать уведомление: UDP может потеряться
+LAN_SKEW = float(os.getenv("LAN_SKEW", "60"))  # Допустимое расхождение часов с сервером, сек
+NET_POLL = float(os.getenv("NET_POLL", "30"))  # Период опроса интерфейсов, если netlink недоступен, сек
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "3"))  # Ожидание TCP-соединения с сервером, сек
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "10"))  # Ожидание ответа сервера (кроме long-poll), сек
+
+# UDP-пинг, формат как в server/core/heartbeat.py
+HB_MAGIC = b"KH\x01"
+HB_REQUEST = struct.Struct("!3s32sQ")  # magic, device_hash, счетчик
+HB_REPLY = struct.Struct("!3sBQH")  # magic, флаги, счетчик, next_ping * 10
+HB_MAC_SIZE = 16
+HB_KILL_FIRST, HB_KILL_SECOND, HB_UNKNOWN, HB_NOT_LEADER = 1, 2, 4, 8
+# Уведомление о kill для соседей, формат как в server/core/lan.py
+LAN_MAGIC = b"KK\x02"
+LAN_NOTICE = struct.Struct("!3sBQQ")  # magic, флаги, начало kill, срок действия
+LAN_SIG_SIZE = 64  # Подпись Ed25519 закрытым ключом сервера
+# Компактный формат /client, как в server/core/wire.py
+MSGPACK = "application/msgpack"
+WIRE_RAW = ("device_hash", "notice")  # В msgpack - байтами, а не hex
+# Группы rtnetlink: линки, IPv4 и IPv6 адреса
+RTMGRP_LINK, RTMGRP_IPV4_IFADDR, RTMGRP_IPV6_IFADDR = 0x1, 0x10, 0x100
 
 server = True
 if NOT_SERVER == "1":
@@ -27,7 +68,8 @@ def get_ip_mac_addresses():
     interface_stats = psutil.net_if_stats()
     ifaces = []
     for iface_name, addrs in interfaces.items():
-        if interface_stats[iface_name].isup:
+        stats = interface_stats.get(iface_name)  # Интерфейс мог пропасть между двумя вызовами
+        if stats is not None and stats.isup:
             ip, mac = None, None
             ip6, mac6 = None, None
             for addr in addrs:
@@ -39,7 +81,7 @@ def get_ip_mac_addresses():
                     ip6 = addr.address
                 elif addr.family == psutil.AF_LINK:  # MAC
                     mac6 = addr.address.replace("-", ":")
-            if ip.startswith(('127.', '224.', '239.')):
+            if ip is not None and ip.startswith(('127.', '224.', '239.')):
                 continue
             if ip6 == "::1":
                 continue
@@ -49,7 +91,6 @@ def get_ip_mac_addresses():
                 ifaces.append((ip, mac))
             if None not in (ip6, mac6):
                 ifaces.append((ip6, mac6))
-    print("Found interfaces:", ifaces)
     return ifaces
 
 def shutdown(log_file=LOG_FILE):
@@ -63,31 +104,108 @@ def shutdown(log_file=LOG_FILE):
     # sys.exit(0)
 
 
+def _sign(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()[:HB_MAC_SIZE]
+
+
+def _to_wire(obj):
+    return {k: bytes.fromhex(v) if k in WIRE_RAW and isinstance(v, str) else v for k, v in obj.items()}
+
+
+def _from_wire(obj):
+    return {k: v.hex() if k in WIRE_RAW and isinstance(v, bytes) else v for k, v in obj.items()}
+
+
 class Host:
     ping_interval = timedelta(seconds=0)
     update_interval = timedelta(seconds=0)
+    wait_timeout = 0  # 0 - сервер не умеет long-poll
+    retry_after = 2  # Начальная пауза при ошибках; сервер присылает свою в update
 
     def __init__(self, endpoint, hash_file):
         self.run = False
+        self.killed = False
 
-        self.endpoint = endpoint
+        self.endpoints = [e.strip() for e in endpoint.split(",") if e.strip()]
+        self.current = 0  # Индекс сервера, который сейчас отвечает
         self.hash_file = Path(hash_file)
         self.session = requests.Session()
+        self.wait_session = requests.Session()  # Отдельная сессия для long-poll потока
+        self.binary = False  # Сервер ответил msgpack - и запросы шлем в msgpack
+        self.status = [False, False]
 
         self.ips = []
         self.macs = []
         self.hostname = None
+        self.ifaces = None
+        self.net_changed = threading.Event()  # Сеть изменилась - пора отправить update
+        self.update_retry = None  # Таймер повтора неудачного update; больше одного не заводим
         self._update_params()
 
         self.last_update = None
         self.device_hash = None
+        self.failures = 0  # Ошибок подряд - для экспоненциальной паузы
+
+        self.heartbeat = None  # (порт, ключ) для UDP-пингов, если сервер их принимает
+        self.hb_socket = None
+        self.hb_counter = 0
+        self.hb_failures = 0
+        self.hb_addresses = {}  # endpoint: ip, чтобы не резолвить имя на каждый пинг
+
+        self.lan = None  # (порт, открытый ключ сервера) для уведомлений о kill от соседей
+        self.lan_socket = None
+        self.lan_lock = threading.Lock()
+        self.notices = set()  # Уже полученные уведомления - каждое пересылаем один раз
 
     def _update_params(self):
         self.hostname = socket.gethostname()
         ifaces = get_ip_mac_addresses()
+        if ifaces != self.ifaces:
+            print("Found interfaces:", ifaces)
+        self.ifaces = ifaces
         self.ips = [ip for ip, _ in ifaces]
         self.macs = [mac for _, mac in ifaces]
 
+    @staticmethod
+    def _netlink():
+        """Сокет rtnetlink с подпиской на изменения линков и адресов; None - не Linux или нет прав"""
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        except OSError as e:
+            print(f"[NET] netlink unavailable ({e}), polling every {NET_POLL}s")
+            return None
+        return sock
+
+    def _watch_network(self):
+        """Ждет изменений сети и будит основной цикл, только если набор интерфейсов правда поменялся"""
+        sock = self._netlink()
+        while self.run:
+            if sock is None:
+                time.sleep(NET_POLL)
+            else:
+                try:
+                    sock.settimeout(None)
+                    sock.recv(65536)
+                    # Смена адреса - это пачка событий: ждем, пока секунду не будет новых
+                    sock.settimeout(1)
+                    try:
+                        while True:
+                            sock.recv(65536)
+                    except socket.timeout:
+                        pass
+                except OSError as e:
+                    # Например, ENOBUFS при шквале событий: часть потеряна - переоткрываем сокет и сверяем интерфейсы
+                    print(f"[NET] netlink error ({e}), reopening")
+                    sock.close()
+                    time.sleep(1)  # Не крутимся, если ошибка повторяется
+                    sock = self._netlink()
+            if get_ip_mac_addresses() != self.ifaces:
+                print("[NET] Interfaces changed")
+                self.net_changed.set()
+
     def _save_hash(self):
         if self.last_update is None or self.device_hash is None:
             print("Can't save hash: last_update or device_hash is None")
@@ -103,27 +221,176 @@ class Host:
         last_update, self.device_hash = d.split("::", 1)
         self.last_update = datetime.fromtimestamp(float(last_update), timezone.utc)
 
-    def api(self, act):
-        j = {"act": act, "device_hash": self.device_hash}
-        if act not in ('ping', 'exit'):
+    def _timeout(self, read=None):
+        """(connect, read) для requests. Без них выключенный сервер держит запрос до таймаута TCP (~2 минуты),
+        а переход на следующий сервер должен укладываться в интервал пинга; read дольше - только у long-poll"""
+        limit = self.ping_interval.total_seconds() or REQUEST_TIMEOUT  # До первого update интервал неизвестен
+        return min(CONNECT_TIMEOUT, limit), read or min(REQUEST_TIMEOUT, limit)
+
+    def api(self, act, session=None, http_timeout=None, **extra):
+        j = {"act": act, "device_hash": self.device_hash, **extra}
+        if act not in ('ping', 'wait', 'exit'):
             j.update({
                 "hostname": self.hostname,
                 "ips": self.ips,
                 "macs": self.macs,
                 "server": server
             })
-        try:
-            s = self.session.post(self.endpoint, json=j).json()
-        except requests.exceptions.RequestException as e:
-            print(f"[API] Error: {e}")
-            if self.run:
-                return {}
-            sys.exit(1)
+        # Сервер недоступен или он резервный - сразу пробуем следующий
+        s = None
+        for _ in range(len(self.endpoints)):
+            current = self.current
+            try:
+                s = self._post(session or self.session, self.endpoints[current], j, self._timeout(http_timeout))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"[API] Error ({self.endpoints[current]}): {e}")
+                s = None
+            if s is not None and s.get("code") != 5:
+                break
+            self.current = (current + 1) % len(self.endpoints)
+        if s is None:
+            return {}  # Ни один сервер не ответил - решает вызывающий, обычно повтором через _backoff
         if s.get("error"):
             if s['code'] != 3:
                 print(f"[API] Error: {s}")
         return s
 
+    def _post(self, session, endpoint, j, http_timeout):
+        """Запрос в msgpack, если сервер его уже понимает, иначе в JSON; в Accept всегда предлагаем msgpack"""
+        headers = {"Accept": f"{MSGPACK}, application/json"} if msgpack is not None else {}
+        if self.binary:
+            r = session.post(endpoint, data=msgpack.packb(_to_wire(j)), timeout=http_timeout,
+                             headers={**headers, "Content-Type": MSGPACK})
+            if r.status_code in (400, 415) and not r.headers.get("Content-Type", "").startswith(MSGPACK):
+                print("[API] Server doesn't accept msgpack, switching to JSON")
+                self.binary = False  # Например, переключились на старый сервер
+        if not self.binary:
+            r = session.post(endpoint, json=j, headers=headers, timeout=http_timeout)
+        if r.headers.get("Content-Type", "").startswith(MSGPACK):
+            self.binary = True
+            return _from_wire(msgpack.unpackb(r.content))
+        return r.json()
+
+    def _backoff(self, r):
+        """Пауза после ошибки: подсказка сервера или экспонента от числа ошибок подряд, со случайным разбросом"""
+        self.failures += 1
+        if isinstance(r.get("retry_after"), (int, float)):
+            delay = r['retry_after']
+        else:
+            delay = min(self.retry_after * 2 ** (self.failures - 1), BACKOFF_MAX)
+        return random.uniform(delay / 2, delay)
+
+    def _next_ping(self, p):
+        """Когда пинговать снова: в назначенное сервером время, иначе через ping_interval с разбросом"""
+        if "status" not in p:
+            return self._backoff(p)
+        self.failures = 0
+        if isinstance(p.get("next_ping"), (int, float)):
+            return p['next_ping']
+        return self.ping_interval.total_seconds() * random.uniform(1 - PING_JITTER, 1 + PING_JITTER)
+
+    def _heartbeat(self):
+        """Пинг по UDP; None - ответа нет или он не годится, надо пинговать по HTTP"""
+        port, key = self.heartbeat
+        endpoint = self.endpoints[self.current]
+        self.hb_counter = counter = max(self.hb_counter + 1, time.time_ns() // 1000)
+        request = HB_REQUEST.pack(HB_MAGIC, bytes.fromhex(self.device_hash), counter)
+        try:
+            if endpoint not in self.hb_addresses:
+                self.hb_addresses[endpoint] = socket.gethostbyname(urlparse(endpoint).hostname)
+            self.hb_socket.sendto(request + _sign(key, request), (self.hb_addresses[endpoint], port))
+            while True:
+                data = self.hb_socket.recv(512)
+                if len(data) != HB_REPLY.size + HB_MAC_SIZE:
+                    continue
+                if not hmac.compare_digest(_sign(key, data[:HB_REPLY.size]), data[HB_REPLY.size:]):
+                    continue
+                magic, flags, echo, next_ping = HB_REPLY.unpack_from(data)
+                if magic == HB_MAGIC and echo == counter:
+                    break
+        except OSError as e:
+            self.hb_failures += 1
+            if self.hb_failures >= 3:
+                print(f"[UDP] Heartbeat failed ({e}), falling back to HTTP")
+                self.heartbeat = None
+            return None
+        self.hb_failures = 0
+        if flags & (HB_UNKNOWN | HB_NOT_LEADER):
+            return None
+        return {"message": "pong", "status": [bool(flags & HB_KILL_FIRST), bool(flags & HB_KILL_SECOND)],
+                "next_ping": next_ping / 10}
+
+    def ping(self):
+        if self.heartbeat is not None:
+            p = self._heartbeat()
+            # При kill нужен ответ по HTTP: только в нем есть уведомление для соседей
+            if p is not None and not (self.lan is not None and any(p['status'])):
+                return p
+        return self.api("ping")
+
+    def _start_lan(self, port, key):
+        self.lan = (port, key)
+        if self.lan_socket is not None:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            sock.bind(("", port))
+        except OSError as e:
+            print(f"[LAN] Can't listen on udp port {port}: {e}")
+            sock.close()
+            return
+        self.lan_socket = sock
+        threading.Thread(target=self._lan_listen, daemon=True).start()
+        print(f" - Listening for kill notices on udp port {port}")
+
+    def _check_notice(self, notice):
+        """Статус из уведомления о kill; None - подпись не сходится, оно устарело или уже было"""
+        if self.lan is None or len(notice) != LAN_NOTICE.size + LAN_SIG_SIZE:
+            return None
+        try:
+            self.lan[1].verify(notice[LAN_NOTICE.size:], notice[:LAN_NOTICE.size])
+        except InvalidSignature:
+            return None
+        magic, flags, started, expires = LAN_NOTICE.unpack_from(notice)
+        if magic != LAN_MAGIC or expires + LAN_SKEW < time.time():
+            return None
+        with self.lan_lock:
+            if notice in self.notices:
+                return None
+            self.notices.add(notice)
+        return [bool(flags & HB_KILL_FIRST), bool(flags & HB_KILL_SECOND)]
+
+    def _broadcast(self, notice):
+        if self.lan_socket is None:
+            return
+        for _ in range(LAN_REPEAT):
+            try:
+                self.lan_socket.sendto(notice, (LAN_BROADCAST, self.lan[0]))
+            except OSError as e:
+                print(f"[LAN] Broadcast failed: {e}")
+                return
+
+    def _relay_notice(self, p):
+        """Уведомление из ответа сервера - соседям, до собственного выключения"""
+        if "notice" in p and self._check_notice(bytes.fromhex(p['notice'])) is not None:
+            print("[LAN] Forwarding kill notice to peers")
+            self._broadcast(bytes.fromhex(p['notice']))
+
+    def _lan_listen(self):
+        while True:
+            try:
+                notice, (address, _) = self.lan_socket.recvfrom(512)
+            except OSError:
+                return
+            status = self._check_notice(notice)
+            if status is None:
+                continue
+            print(f"[LAN] Kill notice from {address}: {status}")
+            self._broadcast(notice)
+            self._handle_status(status)
+
     def shutdown(self, reason="atexit"):
         self.api("shutdown")
         self.run = False
@@ -136,23 +403,72 @@ class Host:
         self._save_hash()
 
     def register(self):
+        """Регистрация; возвращает ответ сервера - без device_hash в нем надо повторить позже"""
         print("Registering...")
         u = self.api("register")
-        if u.get("code") == 3 and u['device_hash'] == self.device_hash:
+        if "device_hash" not in u:
+            print(" - Failed to register")
+        elif u.get("code") == 3 and u['device_hash'] == self.device_hash:
             print(f" - Already registered. Cached device_hash: {self.device_hash}")
-            return
         else:
             self._new_hash(u['device_hash'])
             print(f" - Ready. New device_hash: {self.device_hash}")
+        return u
 
     def update(self):
         print("Updating...")
+        self.net_changed.clear()
+        self._update_params()
         u = self.api("update")
-        _old = self.device_hash
-        if u.get("device_hash") != self.device_hash:
+        if not u or u.get("error") or "ping_interval" not in u:
+            # Сервер недоступен (часто как раз при смене сети) - повторим позже, изменения не теряем
+            if self.update_retry is None or not self.update_retry.is_alive():
+                self.update_retry = threading.Timer(self._backoff(u), self.net_changed.set)
+                self.update_retry.daemon = True
+                self.update_retry.start()
+            return
+        if u['device_hash'] != self.device_hash:
             print(f" - Device hash changed: {self.device_hash} -> {u['device_hash']}")
         else:
             print(" - Device hash not updated")
+        self._new_hash(u['device_hash'])
+        self._apply_settings(u)
+
+    def hello(self):
+        """Один запрос вместо register + ping + ping + update; None - сервер не умеет hello или не ответил"""
+        print("Hello...")
+        self._update_params()
+        u = self.api("hello")
+        if not u or u.get("error") or "ping_interval" not in u:
+            return None
+        if u['device_hash'] != self.device_hash:
+            print(f" - Device hash changed: {self.device_hash} -> {u['device_hash']}")
+        self._new_hash(u['device_hash'])
+        self._apply_settings(u)
+        self.run = True
+        print("Connected to server")
+        self._relay_notice(u)
+        self._handle_status(u['status'])
+        return u
+
+    def _apply_settings(self, u):
+        """Интервалы и ключи из ответа на update/hello"""
+        self.wait_timeout = u.get('wait_timeout', 0)
+        self.retry_after = u.get('retry_after', self.retry_after)
+        self.heartbeat = None
+        if u.get('heartbeat'):
+            self.heartbeat = (u['heartbeat']['port'], bytes.fromhex(u['heartbeat']['key']))
+            self.hb_failures = 0
+            if self.hb_socket is None:
+                self.hb_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.hb_socket.settimeout(HEARTBEAT_TIMEOUT)
+            print(f" - UDP heartbeat on port {self.heartbeat[0]}")
+        if u.get('lan') and Ed25519PublicKey is not None:
+            self._start_lan(u['lan']['port'], Ed25519PublicKey.from_public_bytes(bytes.fromhex(u['lan']['key'])))
+        else:
+            if u.get('lan'):
+                print(" - LAN kill notices need the cryptography package, not listening")
+            self.lan = None
         _pi, _ui = u['ping_interval'], u['update_interval']
         if self.ping_interval.total_seconds() != _pi or self.update_interval.total_seconds() != _ui:
             self.ping_interval = timedelta(seconds=_pi)
@@ -160,46 +476,78 @@ class Host:
             print(f" - Intervals updated: ping={self.ping_interval}; update={self.update_interval}")
         else:
             print(f" - Intervals not updated")
-        self.last_update = datetime.now(timezone.utc)
 
-    def _pre_start(self, i=0):
-        if i > 3:
-            print("Can't connect to server. Exiting...")
-            sys.exit(1)
-        self.register()
-        p = self.api("ping")
-        if p.get("code") == 4:
-            self.device_hash = None
-            return self._pre_start(i+1)
-        if self.api("ping").get("message") == "pong":
-            print("Connected to server")
-            self.run = True
+    def _pre_start(self):
+        """Регистрация и первый пинг. При массовом включении сервер может еще не подняться или отвечать 500 -
+        ждем паузу из _backoff (retry_after сервера или экспонента со случайным разбросом), а не выходим"""
+        while True:
+            p = self.register()
+            if "device_hash" in p:
+                p = self.api("ping")
+                if "status" in p:
+                    self.failures = 0
+                    print("Connected to server")
+                    self.run = True
+                    return
+                if p.get("code") == 4:
+                    self.device_hash = None  # Сервер нас не знает - зарегистрируемся заново
+            time.sleep(self._backoff(p))
+
+    def _handle_status(self, status):
+        kill_first, kill_second = self.status = status
+        if self.killed:
+            return
+        if kill_first:
+            if not server:
+                print("Received kill_first request. Shutting down...")
+                self.killed = True
+                shutdown(LOG_FILE)
+            else:
+                print("Received kill_first request, but client registered as server. Ignoring...")
+        if kill_second:
+            print("Received kill_second request. Shutting down...")
+            self.killed = True
+            shutdown(LOG_FILE)
+
+    def _watch(self):
+        """Long-poll: сервер отвечает сразу, как только меняется статус"""
+        while self.run and self.wait_timeout:
+            p = self.api("wait", self.wait_session, self.wait_timeout + 10, status=self.status, timeout=self.wait_timeout)
+            if p.get("code") == 4 and p.get("error") == "invalid data: act":
+                print("Server does not support long-poll")
+                return
+            if "status" not in p:
+                time.sleep(self._backoff(p))  # Ошибка - не долбим сервер
+                continue
+            self._relay_notice(p)
+            self._handle_status(p['status'])
 
     def start(self):
         print(f'Mode: {"server" if server else "app"}')
         self._read_hash()
-        self._pre_start()
-        self.update()
+        # После включения питания все машины стартуют разом - расходимся, чтобы не прийти на сервер толпой
+        time.sleep(random.uniform(0, STARTUP_JITTER))
+        hello = self.hello() if self.device_hash is not None else None
+        if hello is None:
+            self._pre_start()
+            self.update()
+        threading.Thread(target=self._watch, daemon=True).start()
+        threading.Thread(target=self._watch_network, daemon=True).start()
+        if hello is not None:
+            self.net_changed.wait(self._next_ping(hello))  # hello уже был пингом
         while self.run:
-            if datetime.now(timezone.utc) - self.update_interval > self.last_update:
+            if self.net_changed.is_set() or datetime.now(timezone.utc) - self.update_interval > self.last_update:
                 self.update()
-            p = self.api("ping")
+            p = self.ping()
             if p.get("code") == 4:
                 print('wtf')
                 self._pre_start()
 
-            kill_first, kill_second = p['status']
-            if kill_first:
-                if not server:
-                    print("Received kill_first request. Shutting down...")
-                    shutdown(LOG_FILE)
-                else:
-                    print("Received kill_first request, but client registered as server. Ignoring...")
-            if kill_second:
-                print("Received kill_second request. Shutting down...")
-                shutdown(LOG_FILE)
+            if "status" in p:
+                self._relay_notice(p)
+                self._handle_status(p['status'])
 
-            time.sleep(self.ping_interval.total_seconds())
+            self.net_changed.wait(self._next_ping(p))  # Сеть поменялась - не ждем следующего пинга
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+UPSTREAM = os.getenv("UPSTREAM", "http://192.168.250.54:5000/client")  # Можно несколько через запятую
+LISTEN = os.getenv("LISTEN", "0.0.0.0:5000")
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
+WAIT_TIMEOUT = float(os.getenv("WAIT_TIMEOUT", "30"))
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "3"))  # Ожидание TCP-соединения с сервером, сек
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "10"))  # Ожидание ответа сервера (кроме long-poll), сек
+
+
+def get_error(code, message=None):
+    # Та же форма ошибок, что и у сервера
+    match code:
+        case 4:
+            error = f"invalid data: {message}"
+        case 8:
+            error = f"external client error: {message}"
+        case _:
+            error = f"relay error: {message}"
+    return {"error": error, "code": code, "http_code": 200}
+
+
+class Relay:
+    """Relay площадки: копит пинги локальных клиентов и шлет их на сервер пачками, статус раздает вниз"""
+
+    def __init__(self, upstream):
+        self.upstreams = [u.strip() for u in upstream.split(",") if u.strip()]
+        self.current = 0
+        self.session = requests.Session()
+        self.wait_session = requests.Session()
+        self.run = True
+
+        self.status = [False, False]
+        self.notice = None  # Подписанное сервером уведомление о kill, клиенты разошлют его по своей сети
+        self.changed = threading.Condition()
+
+        self.lock = threading.Lock()
+        self.pending = {}  # device_hash: запрос (ping/shutdown); пинги одного хоста схлопываются
+        self.unknown = set()  # device_hash, которых сервер не знает
+
+    def post(self, data, session=None, timeout=None):
+        """Запрос на ведущий сервер; недоступный или резервный сервер пропускаем.
+        timeout - ожидание ответа, дольше обычного нужно только long-poll; соединение всегда ждем
+        не дольше интервала отправки, иначе выключенный сервер держит запрос до таймаута TCP"""
+        timeout = (min(CONNECT_TIMEOUT, FLUSH_INTERVAL), timeout or min(REQUEST_TIMEOUT, FLUSH_INTERVAL))
+        for attempt in range(len(self.upstreams)):
+            current = self.current
+            try:
+                r = (session or self.session).post(self.upstreams[current], json=data, timeout=timeout).json()
+            except requests.exceptions.RequestException:
+                if attempt == len(self.upstreams) - 1:
+                    raise
+                r = None
+            if r is not None and (r.get("code") != 5 or attempt == len(self.upstreams) - 1):
+                return r
+            self.current = (current + 1) % len(self.upstreams)
+
+    def set_status(self, status, notice=None):
+        with self.changed:
+            self.notice = notice
+            if status != self.status:
+                print(f"[relay] Status changed: {self.status} -> {status}")
+                self.status = status
+                self.changed.notify_all()
+
+    def handle(self, data):
+        """Ответ локальному клиенту"""
+        act, device_hash = data.get('act'), data.get('device_hash')
+        match act:
+            case "ping" | "wait":
+                with self.lock:
+                    if device_hash in self.unknown:
+                        self.unknown.discard(device_hash)
+                        return get_error(4, "unknown device")
+                    self.pending.setdefault(device_hash, {"act": "ping", "device_hash": device_hash})
+                if act == "ping":
+                    return self._pong(self.status)
+                return self._pong(self.wait(data.get('status'), data.get('timeout')))
+            case "shutdown":
+                with self.lock:
+                    self.pending[device_hash] = {"act": "shutdown", "device_hash": device_hash}
+                return {"message": 0}
+            case _:
+                # register/update и прочее: ответ нужен клиенту сразу
+                with self.lock:
+                    self.unknown.discard(device_hash)
+                r = self.post(data)
+                r.pop("heartbeat", None)  # UDP-пинги relay не пересылает - клиенты за ним пингуют по HTTP
+                return r
+
+    def _pong(self, status):
+        r = {"message": "pong", "status": status}
+        if self.notice is not None and any(status):
+            r['notice'] = self.notice
+        return r
+
+    def wait(self, status, timeout):
+        if not isinstance(timeout, (int, float)):
+            timeout = WAIT_TIMEOUT
+        deadline = time.monotonic() + min(timeout, WAIT_TIMEOUT)
+        with self.changed:
+            while self.status == status:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.changed.wait(left)
+            return self.status
+
+    def flush(self):
+        """Отправка накопленных пингов и shutdown одной пачкой"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        items = list(pending.values())
+        try:
+            r = self.post({"act": "batch", "items": items})
+        except requests.exceptions.RequestException as e:
+            r = {"error": str(e)}
+        if r.get("error"):
+            print(f"[relay] Upstream error: {r['error']}")
+            with self.lock:
+                for device_hash, item in pending.items():
+                    self.pending.setdefault(device_hash, item)  # Повторим в следующий раз
+            return
+        with self.lock:
+            for item, result in zip(items, r['results']):
+                if result.get("code") == 4:
+                    self.unknown.add(item['device_hash'])
+        self.set_status(r['status'], r.get('notice'))
+
+    def _flusher(self):
+        while self.run:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def _watcher(self):
+        """Long-poll к серверу: kill доходит до relay сразу"""
+        while self.run:
+            try:
+                r = self.post({"act": "wait", "status": self.status, "timeout": WAIT_TIMEOUT},
+                              self.wait_session, WAIT_TIMEOUT + 10)
+            except requests.exceptions.RequestException as e:
+                print(f"[relay] Upstream error: {e}")
+                time.sleep(FLUSH_INTERVAL)
+                continue
+            if "status" not in r:
+                print(f"[relay] Upstream does not support long-poll: {r}")
+                return
+            self.set_status(r['status'], r.get('notice'))
+
+    def start(self):
+        threading.Thread(target=self._flusher, daemon=True).start()
+        threading.Thread(target=self._watcher, daemon=True).start()
+
+    def stop(self):
+        self.run = False
+        self.flush()
+
+
+def make_handler(relay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/client":
+                self.send_error(404)
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if isinstance(data, str):
+                    data = json.loads(data)
+                r = relay.handle(data)
+            except (json.JSONDecodeError, AttributeError) as e:
+                r = get_error(8, e)
+            except requests.exceptions.RequestException as e:
+                r = get_error(9, f"upstream: {e}")
+            body = json.dumps(r).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    print("Starting relay...")
+    host, port = LISTEN.rsplit(":", 1)
+    relay = Relay(UPSTREAM)
+    relay.start()
+    httpd = ThreadingHTTPServer((host, int(port)), make_handler(relay))
+    httpd.daemon_threads = True
+    print(f"Listening on {LISTEN}, upstream: {UPSTREAM}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        print("Exited...")
@@ -7,14 +7,22 @@ from datetime import datetime
 
 from loguru import logger
 
-from .config import Config
+from .config import Config, Notify
 from .datastore import Host, HostDatabase
+from .storage import Storage, open_storage
+from .api import Api, Wait, get_error
+from .notify import Dispatcher
+from .logs import hot, AccessFilter
 
 aparser = argparse.ArgumentParser(description="Killer server")
 aparser.add_argument("-c", "--config", type=str, default="/etc/killer/config.json", help="Path to config file")
+aparser.add_argument("-m", "--mode", choices=("flask", "asyncio"), default=None, help="Server mode (overrides config)")
+aparser.add_argument("-p", "--port", type=int, default=None, help="Server port (overrides config)")
 args = aparser.parse_args()
 
 config = Config(args.config)
+if args.port is not None:
+    config.server.port = args.port
 
 # configure logging
 logger.remove()
@@ -38,7 +46,9 @@ if system == "Linux":
 else:
     logger.add(sys.stdout, level="DEBUG", backtrace=False, diagnose=False, enqueue=True,
                format="\r<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | {message}")
-    logger.add("debug.log", level="DEBUG", rotation="10 MB", retention="30 day")
+    logger.add("debug.log", level="DEBUG", rotation="10 MB", retention="30 day", enqueue=True)
+hot.configure(config.log.summary_interval, config.log.repeat_interval)
+logging.getLogger("werkzeug").addFilter(AccessFilter(hot))
 
 class InterceptHandler(logging.Handler):
     def emit(self, record):
@@ -0,0 +1,300 @@
+import json
+import time
+from datetime import timedelta
+
+from loguru import logger
+
+from .config import generate_hash
+from .datastore import Host
+from .heartbeat import KILL_FIRST, KILL_SECOND, UNKNOWN, NOT_LEADER, host_key
+from .lan import fleet_key, kill_notice, public_key
+from .sessions import Sessions
+
+
+def get_error(code, message=None, http_code=200, _add=None):
+    err = {"error": None, "code": code, "http_code": http_code}
+    match code:
+        case 1:
+            err['error'] = f"missing data: {message}"
+        case 2:
+            err['error'] = f"register first ({message})"
+        case 3:
+            err['error'] = "already registered"
+        case 4:
+            err['error'] = f"invalid data: {message}"
+        case 5:
+            err['error'] = "not leader"
+        case 8:
+            err['error'] = f"external client error: {message}"
+        case 9:
+            err['error'] = f"internal server error: {message}"
+        case _:
+            err['error'] = f"unknown error ({message})"
+    if _add is not None:
+        err.update(_add)
+    return err
+
+
+def _get_host_info(act, data):
+    hostname, ips, macs, server = data.get('hostname'), data.get('ips'), data.get('macs'), data.get("server")
+    # Проверяем данные
+    if act in ("register", "update", "hello"):
+        if not all((hostname, ips, macs)):
+            return False, get_error(1, "hostname, ips, macs")
+        if not isinstance(hostname, str):
+            return False, get_error(4, "hostname must be a string")
+        if not isinstance(ips, list) or not isinstance(macs, list):
+            return False, get_error(4, "ips and macs must be lists")
+        if not isinstance(server, bool):
+            return False, get_error(4, "server must be a boolean")
+    return True, hostname, ips, macs, server
+
+
+class Wait:
+    """Отложенный ответ на act=wait: как именно ждать, решает веб-сервер (поток или event loop)"""
+    __slots__ = ("status", "timeout", "notice")
+
+    def __init__(self, status, timeout, notice):
+        self.status = status
+        self.timeout = timeout
+        self.notice = notice
+
+    def result(self, status):
+        r = {"message": "pong", "status": status}
+        if (notice := self.notice(status)) is not None:
+            r['notice'] = notice
+        return r
+
+
+class Api:
+    """Логика /client и /admin/api, общая для Flask и asyncio серверов"""
+
+    def __init__(self, host_db, delays, config):
+        self.host_db = host_db
+        self.delays = delays
+        self.config = config
+        self._users = {user.digest: user for user in config.auth}
+        self.sessions = Sessions(config.server.session_ttl)
+        self.replicator = None  # Есть, если включена репликация
+        self._fleet_key = fleet_key(config.lan.secret) if config.lan.enabled else None
+        self._fleet_public = None if self._fleet_key is None else public_key(self._fleet_key).hex()
+        self._notice = (None, None)  # (статус, начало, срок), уведомление
+
+    def _not_leader(self):
+        if self.replicator is None or self.replicator.leader:
+            return None
+        if self.replicator.leader_url is None:  # Идут выборы - ведущий появится не раньше, чем через lease
+            return get_error(5, _add={"leader": None, "retry_after": self.replicator.lease})
+        return get_error(5, _add={"leader": self.replicator.leader_url})
+
+    def next_ping(self, device_hash):
+        """Через сколько секунд хосту пинговать снова: у каждого хоста свое место в интервале по его хешу,
+        поэтому пинги включившихся одновременно хостов расходятся равномерно"""
+        half = self.config.client['ping_interval'] / 2
+        phase = int(device_hash[:8], 16) / 0x100000000 * half
+        return round(half + (phase - time.time()) % half, 2)
+
+    def client(self, data):
+        """Обработка запроса клиента; для act=wait возвращает Wait"""
+        if (err := self._not_leader()) is not None:
+            return err
+        if isinstance(data, str):
+            data = json.loads(data)
+        device_hash = data.get('device_hash')  # Ожидаем, что клиент отправит свой уникальный хеш
+        act = data.get('act')  # Что хочет клиент
+        if act in ("batch", "wait") and device_hash is None:
+            pass  # Пачка от relay или наблюдатель без своего хоста
+        elif act != "register":
+            if not all((device_hash, act)):
+                return get_error(1, "device_hash or act")
+            if len(device_hash) != 64:
+                return get_error(2, "bad device_hash")
+        _tmp = _get_host_info(act, data)
+        ok, host_info = _tmp[0], _tmp[1:]
+        if not ok:
+            return _tmp[1]  # Ошибка
+        match act:
+            case "register":  # Регистрируем новое устройство
+                host = Host(*host_info)
+                o = {"device_hash": host.device_hash}
+                if host.registered():
+                    return get_error(3, _add=o)
+                host.save()
+                return o
+            case "update":  # раз в 12 часов обновляем данные от клиента
+                host = self.host_db.get(device_hash)
+                if host is None:
+                    return get_error(2)
+                _device_hash = host.update(*host_info)
+                return self._settings(host)
+            case "hello":  # register + ping + update одним запросом от клиента с сохраненным хешем
+                host = self.host_db.get(device_hash)
+                if host is None:  # Хеш устарел или сервер хост забыл - регистрируем заново
+                    host = Host(*host_info)
+                    host = self.host_db.get(host.device_hash) or host
+                    if not host.registered():
+                        host.save()
+                if (host.hostname, host.ips, host.macs, host.server) != host_info:
+                    host.update(*host_info)
+                else:
+                    host.ping()
+                return self._settings(host) | self._pong(host.device_hash)
+            case "ping":  # раз в 1 минуту клиент шлет пинг
+                host = self.host_db.get(device_hash)
+                if host is None:
+                    return get_error(4, "unknown device")
+                host.ping()
+                return self._pong(device_hash)
+            case "wait":  # клиент держит запрос, пока не сменится статус (или до таймаута)
+                host = None
+                if device_hash is not None:
+                    host = self.host_db.get(device_hash)
+                    if host is None:
+                        return get_error(4, "unknown device")
+                status = data.get('status', [False, False])
+                if not isinstance(status, list) or len(status) != 2:
+                    return get_error(4, "status must be a list of two booleans")
+                timeout = self.config.client['wait_timeout']
+                if isinstance(data.get('timeout'), (int, float)):
+                    timeout = max(0, min(data['timeout'], timeout))
+                if host is not None:
+                    host.ping()
+                return Wait(tuple(status), timeout, self.kill_notice)
+            case "shutdown":  # клиент завершает работу
+                host = self.host_db.get(device_hash)
+                if host is None:
+                    return get_error(4, "unknown device")
+                host.shutdown()
+                return {"message": 0}
+            case "batch":  # пачка запросов разных хостов (от relay)
+                items = data.get('items')
+                if not isinstance(items, list):
+                    return get_error(4, "items must be a list")
+                r = {"results": [self._batch_item(item) for item in items], "status": self.delays.status()}
+                if (notice := self.kill_notice(r['status'])) is not None:
+                    r['notice'] = notice
+                return r
+            case _:
+                return get_error(4, "act")
+
+    def kill_notice(self, status):
+        """Подписанное уведомление о kill (hex), которое клиенты разошлют по своей сети, или None"""
+        if self._fleet_key is None or not any(status):
+            return None
+        started = int(self.delays.history[-1])
+        expires = int(time.time() + (self.delays.next_change() or 0)) + 1  # Конец текущей фазы
+        key = (tuple(status), started, expires)
+        if self._notice[0] != key:
+            flags = KILL_FIRST * status[0] | KILL_SECOND * status[1]
+            self._notice = (key, kill_notice(self._fleet_key, flags, started, expires).hex())
+        return self._notice[1]
+
+    def heartbeat(self, device_hash):
+        """UDP-пинг: (флаги, next_ping) - то же, что act=ping, но без JSON"""
+        if self.replicator is not None and not self.replicator.leader:
+            return NOT_LEADER, 0
+        host = self.host_db.get(device_hash)
+        if host is None:
+            return UNKNOWN, 0
+        host.ping()
+        kill_first, kill_second = self.delays.status()
+        return KILL_FIRST * kill_first | KILL_SECOND * kill_second, self.next_ping(device_hash)
+
+    def _settings(self, host):
+        """Интервалы и ключи для клиента - ответ на update и hello"""
+        r = {"device_hash": host.device_hash, "update_interval": self.config.client['update_interval'],
+             "ping_interval": self.config.client['ping_interval'],
+             "wait_timeout": self.config.client['wait_timeout'],
+             "retry_after": self.config.client['retry_after']}
+        if self._fleet_key is not None:
+            r['lan'] = {"port": self.config.lan.port, "key": self._fleet_public}
+        if self.config.heartbeat.enabled:
+            r['heartbeat'] = {"port": self.config.heartbeat.port,
+                              "key": host_key(self.config.heartbeat.secret, host.device_hash).hex()}
+        return r
+
+    def _pong(self, device_hash):
+        r = {"message": "pong", "status": self.delays.status(), "next_ping": self.next_ping(device_hash)}
+        if (notice := self.kill_notice(r['status'])) is not None:
+            r['notice'] = notice
+        return r
+
+    def _batch_item(self, item):
+        if not isinstance(item, dict):
+            return get_error(4, "item must be an object")
+        if item.get('act') in ("batch", "wait"):
+            return get_error(4, "act")
+        # Кривой элемент портит только свой слот, а не весь batch
+        try:
+            return self.client(item)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            return get_error(4, f"{type(e).__name__}: {e}")
+        except Exception as e:
+            logger.exception(e)
+            return get_error(9, str(e), 500)
+
+    def login(self, username, password):
+        """Проверка логина; при успехе - токен новой сессии"""
+        user = self._users.get(generate_hash(username, password))
+        if user is None:
+            return None
+        return self.sessions.create(user)
+
+    def check_cookie(self, session):
+        return self.sessions.get(session) is not None
+
+    def admin(self, method, remote_addr, data=None):
+        data = data or {}
+        match method:
+            case "kill_all":
+                if (err := self._not_leader()) is not None:
+                    return err
+                logger.info(f"Kill all command received from {remote_addr}")
+                hosts = [host for host in self.host_db.all() if host.is_active()]
+                self.delays.kill_request({host.device_hash for host in hosts if not host.server},
+                                         {host.device_hash for host in hosts if host.server})
+                return {"message": "Command added to queue"}
+            case "updates":
+                since = data.get('since')
+                if since is not None and not isinstance(since, int):
+                    return get_error(4, "since must be an integer")
+                return self.updates(since)
+            case "history":
+                return self.history(data.get('device_hash'), data.get('hours', 24))
+            case _:
+                return get_error(4, "method")
+
+    def updates(self, since=None):
+        """Изменения хостов после версии since (без since - все хосты)"""
+        version, hosts, removed, full = self.host_db.changes(since)
+        return {"status": self.delays.status(), "kill": self.delays.report(), "version": version, "full": full,
+                "hosts": [host.to_dict() for host in hosts], "removed": removed}
+
+    def history(self, device_hash=None, hours=24):
+        """Доступность и переходы состояния хоста (без device_hash - сводка по всем)"""
+        if not self.host_db.keeps_history:
+            return get_error(4, "history is not available with server.workers > 1")
+        if not isinstance(hours, (int, float)) or hours <= 0:
+            return get_error(4, "hours must be a positive number")
+        window = timedelta(hours=hours)
+        if device_hash is not None:
+            host = self.host_db.get(device_hash)
+            if host is None:
+                return get_error(4, "device_hash")
+            return {"hostname": host.hostname, "device_hash": device_hash,
+                    **(self.host_db.uptime(device_hash, window) or {})}
+        hosts = []
+        for host in self.host_db.all():
+            u = self.host_db.uptime(host.device_hash, window)
+            if u is not None:
+                u.pop("history")
+                hosts.append({"hostname": host.hostname, "device_hash": host.device_hash, **u})
+        return {"hours": hours, "hosts": hosts}
+
+    def stream_event(self, since, status):
+        """Один шаг SSE-потока: (событие или None, since, status); сервер зовет его раз в секунду"""
+        current = self.delays.status()
+        if since is not None and since == self.host_db.version and current == status:
+            return None, since, status
+        u = self.updates(since)
+        return f"data: {json.dumps(u)}\n\n", u['version'], current
@@ -0,0 +1,189 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import jinja2
+from aiohttp import web
+from loguru import logger
+
+from . import wire
+from .api import Wait, get_error
+from .logs import hot
+
+
+class AsyncServer:
+    """asyncio-режим сервера: /client и /admin на aiohttp, без потока на соединение"""
+
+    def __init__(self, api, templates_dir, workers=32):
+        self.api = api
+        self.delays = api.delays
+        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir),
+                                            autoescape=jinja2.select_autoescape())
+        # Работа с datastore и уведомления уходят сюда, event loop только держит соединения
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="killer-io")
+        self.loop = None
+        self._changed = None  # Future, пересоздается на каждый kill_request
+
+    def _on_kill(self):
+        # Вызывается из любого потока
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self._changed.set_result(None)
+        self._changed = self.loop.create_future()
+
+    async def wait_change(self, status, timeout):
+        """То же, что Delays.wait_change, но без блокировки потока"""
+        deadline = self.loop.time() + timeout
+        while True:
+            current = self.delays.status()
+            left = deadline - self.loop.time()
+            if current != status or left <= 0:
+                return current
+            next_change = self.delays.next_change()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._changed),
+                                       left if next_change is None else min(left, next_change))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def _check_cookie(self, request):
+        return self.api.check_cookie(request.cookies.get('sid'))
+
+    def _render(self, template, **context):
+        # Flash-сообщений в этом режиме нет
+        return self.templates.get_template(template).render(get_flashed_messages=lambda **kw: [], **context)
+
+    async def client_update(self, request):
+        try:
+            if wire.is_msgpack(request.content_type):
+                data = wire.unpack(await request.read())
+            else:
+                data = json.loads(await request.read())
+        except ValueError as e:  # JSONDecodeError и UnicodeDecodeError - тоже ValueError
+            return web.json_response(get_error(8, str(e), 400), status=400)
+        r = await self._run(self.api.client, data)
+        if isinstance(r, Wait):
+            r = r.result(await self.wait_change(r.status, r.timeout))
+        if wire.accepts(request.headers.get('Accept')):
+            return web.Response(body=wire.pack(r), content_type=wire.MSGPACK)
+        return web.json_response(r)
+
+    async def login(self, request):
+        form = await request.post()
+        session = self.api.login(form.get('username'), form.get('password'))
+        if session is None:
+            logger.warning(f"Invalid login or password from {request.remote}")
+            raise web.HTTPFound("/admin")
+        logger.success(f"Admin logged in from {request.remote}")
+        response = web.HTTPFound("/admin/dashboard")
+        response.set_cookie('sid', session, max_age=self.api.sessions.ttl, httponly=True)
+        raise response
+
+    async def admin_index(self, request):
+        if self._check_cookie(request):
+            raise web.HTTPFound("/admin/dashboard")
+        logger.info(f"Login page opened from {request.remote}")
+        return web.Response(text=self._render('index.html'), content_type="text/html")
+
+    async def admin_dashboard(self, request):
+        if not self._check_cookie(request):
+            hot.limited(("cookie", request.remote), "WARNING", "Bad cookie from {}", request.remote)
+            raise web.HTTPFound("/admin")
+        logger.info(f"Admin dashboard opened from {request.remote}")
+        html = await self._run(lambda: self._render('dashboard.html', timeouts=self.delays,
+                                                    hosts=self.api.host_db.all()))
+        return web.Response(text=html, content_type="text/html")
+
+    async def admin_api(self, request):
+        if not self._check_cookie(request):
+            hot.limited(("cookie", request.remote), "WARNING", "Bad cookie from {}", request.remote)
+            return web.json_response(get_error(4, "invalid cookie"), status=403)
+        data = None
+        if request.can_read_body:
+            try:
+                data = json.loads(await request.read())
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                pass
+        r = await self._run(self.api.admin, request.match_info['method'], request.remote, data)
+        response = web.json_response(r)
+        if len(response.body) >= wire.COMPRESS_MIN:
+            response.enable_compression()  # gzip/deflate - смотря что в Accept-Encoding
+        return response
+
+    async def admin_stream(self, request):
+        """SSE: дашборд получает изменения хостов по мере их появления"""
+        if not self._check_cookie(request):
+            return web.json_response(get_error(4, "invalid cookie"), status=403)
+        since = request.query.get('since')
+        since = int(since) if since and since.isdigit() else None
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        status, idle = None, 0
+        while True:
+            event, since, status = await self._run(self.api.stream_event, since, status)
+            if event is not None:
+                idle = 0
+                await response.write(event.encode())
+            elif idle >= 15:
+                idle = 0
+                await response.write(b": keepalive\n\n")
+            idle += 1
+            await asyncio.sleep(1)
+
+    async def replication(self, request):
+        replicator = self.api.replicator
+        if replicator is None or not replicator.check_secret(request.headers.get('X-Killer-Secret')):
+            return web.json_response(get_error(4, "replication"), status=403)
+        try:
+            data = json.loads(await request.read())
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            data = None
+        return web.json_response(await self._run(replicator.handle, data))
+
+    @web.middleware
+    async def handle_error(self, request, handler):
+        try:
+            return await handler(request)
+        except web.HTTPRedirection:
+            raise
+        except web.HTTPException as e:
+            return web.json_response(get_error(8, e.reason, e.status), status=e.status)
+        except Exception as e:
+            logger.exception(e)
+            return web.json_response(get_error(9, str(e), 500, {"retry_after": self.api.config.client['retry_after']}),
+                                     status=500)
+
+    async def _on_startup(self, app):
+        self.loop = asyncio.get_running_loop()
+        self._changed = self.loop.create_future()
+        self.delays.listeners.append(self._on_kill)
+
+    async def _on_cleanup(self, app):
+        self.delays.listeners.remove(self._on_kill)
+        self.executor.shutdown(wait=False)
+
+    def app(self):
+        app = web.Application(middlewares=[self.handle_error])
+        app.add_routes([
+            web.post('/client', self.client_update),
+            web.post('/admin', self.login),
+            web.get('/admin', self.admin_index),
+            web.get('/admin/dashboard', self.admin_dashboard),
+            web.get('/admin/api/stream', self.admin_stream),
+            web.post('/admin/api/{method}', self.admin_api),
+            web.post('/replication', self.replication),
+        ])
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    def run(self, host, port, sock=None):
+        """sock - уже открытый сокет (воркеры prefork), тогда host и port не используются"""
+        logger.info(f"Starting asyncio server on {host}:{port}")
+        if sock is not None:
+            host = port = None
+        web.run_app(self.app(), host=host, port=port, sock=sock, backlog=4096, print=None)
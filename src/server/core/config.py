@@ -1,8 +1,12 @@
 import hashlib
 import json
+import os
 import platform
 import secrets
 import sys
+import threading
+import time
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from pathlib import Path
@@ -16,29 +20,179 @@ from loguru import logger
 class Delays:
     kill_first: int
     kill_second: int
-    history: list[float] = field(default_factory=lambda: [0.0, ])
-
-    def __is_kill_first(self):
-        current_time = datetime.now(timezone.utc).timestamp()
-        if current_time - self.history[-1] < self.kill_first:
-            return True
-        return False
-
-    def __is_kill_second(self):
-        current_time = datetime.now(timezone.utc).timestamp()
-        return current_time - self.history[-1] < self.kill_first + self.kill_second
+    state_file: Path = None  # Здесь kill переживает перезапуск сервера
+    history: deque = field(default_factory=lambda: deque(maxlen=100), init=False)  # Время kill_request, UTC
+    _changed: threading.Condition = field(default_factory=threading.Condition, init=False, repr=False, compare=False)
+    listeners: list = field(default_factory=list, init=False, repr=False, compare=False)  # вызываются при kill_request
+    # Текущий kill на time.monotonic(): границы фаз считаются только на kill_request и ack
+    _started: float = field(default=None, init=False, repr=False, compare=False)
+    _first_end: float = field(default=float("-inf"), init=False, repr=False, compare=False)
+    _second_end: float = field(default=float("-inf"), init=False, repr=False, compare=False)
+    # Подтверждения kill: [хосты-приложения, все хосты]; None - kill без отслеживания
+    _pending: list = field(default_factory=lambda: [None, None], init=False, repr=False, compare=False)
+    _expected: list = field(default_factory=lambda: [0, 0], init=False, repr=False, compare=False)
+    _acked: list = field(default_factory=lambda: [None, None], init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.state_file is not None:
+            self.state_file = Path(self.state_file)
+            self._load()
+
+    def _recompute(self):
+        """Концы фаз текущего kill: по таймауту или раньше, если все подтвердили"""
+        first = self._started + self.kill_first
+        if self._acked[0] is not None:
+            first = min(first, self._acked[0])
+        second = first + self.kill_second
+        if self._acked[1] is not None:
+            second = max(first, min(second, self._acked[1]))
+        self._first_end, self._second_end = first, second
+
+    def state(self):
+        """Текущий kill в виде, пригодном для диска и репликации; None - kill еще не было"""
+        if self._started is None:
+            return None
+        return {
+            "started": self.history[-1],
+            "acked": [None if a is None else a - self._started for a in self._acked],
+            "pending": [None if p is None else list(p) for p in self._pending],
+            "expected": self._expected,
+            "history": list(self.history)
+        }
+
+    def restore(self, state):
+        """kill из state(): с диска при старте или от ведущего сервера"""
+        with self._changed:
+            self.history.clear()
+            self.history.extend(state['history'])
+            # Стенные часы только здесь: переводим начало kill в monotonic этого процесса
+            elapsed = max(0.0, datetime.now(timezone.utc).timestamp() - state['started'])
+            self._started = time.monotonic() - elapsed
+            self._acked = [None if a is None else self._started + a for a in state['acked']]
+            self._pending = [None if p is None else set(p) for p in state['pending']]
+            self._expected = state['expected']
+            self._recompute()
+            self._save()
+            self._changed.notify_all()
+        [listener() for listener in self.listeners]
+        return elapsed
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        tmp = self.state_file.with_name(self.state_file.name + ".tmp")
+        tmp.write_text(json.dumps(self.state()), "utf-8")
+        os.replace(tmp, self.state_file)
+
+    def _load(self):
+        if not self.state_file.exists():
+            return
+        try:
+            state = json.loads(self.state_file.read_text("utf-8"))
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"[delays] Can't read kill state {self.state_file}: {e}")
+            return
+        if state is None:
+            return
+        elapsed = self.restore(state)
+        if self.status() != (False, False):
+            logger.warning(f"[delays] Resuming kill started {elapsed:.1f}s ago, status: {self.status()}")
 
     def status(self) -> tuple[bool, bool]:
         # app -> severs
-        if self.__is_kill_first():
+        current_time = time.monotonic()
+        if current_time < self._first_end:
             return True, False
-        elif self.__is_kill_second():
+        elif current_time < self._second_end:
             return False, True
         return False, False
 
-    def kill_request(self):
-        self.history.append(datetime.now(timezone.utc).timestamp())
-        logger.warning(f"Killing history updated: {self.history}")
+    def next_change(self):
+        """Секунд до смены статуса по времени"""
+        current_time = time.monotonic()
+        for boundary in (self._first_end, self._second_end):
+            if current_time < boundary:
+                return boundary - current_time
+        return None
+
+    def wait_change(self, status, timeout) -> tuple[bool, bool]:
+        """Ожидание смены статуса относительно известного клиенту (long-poll)"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                current = self.status()
+                left = deadline - time.monotonic()
+                if current != tuple(status) or left <= 0:
+                    return current
+                next_change = self.next_change()
+                self._changed.wait(left if next_change is None else min(left, next_change))
+
+    def kill_request(self, app_hosts=None, server_hosts=None):
+        """app_hosts/server_hosts - hash хостов, от которых ждем подтверждения (shutdown или неактивность)"""
+        with self._changed:
+            now = time.monotonic()
+            self._started = now
+            self.history.append(datetime.now(timezone.utc).timestamp())
+            self._acked = [None, None]
+            if app_hosts is None:
+                self._pending = [None, None]
+            else:
+                self._pending = [set(app_hosts), set(app_hosts) | set(server_hosts or ())]
+                self._expected = [len(p) for p in self._pending]
+                self._acked = [None if p else now for p in self._pending]
+            self._recompute()
+            self._save()
+            self._changed.notify_all()  # Будим всех ждущих клиентов
+        [listener() for listener in self.listeners]
+        logger.warning(f"Kill requested at {datetime.fromtimestamp(self.history[-1], timezone.utc)}")
+
+    def ack(self, device_hash):
+        """Хост выключился или пропал: если он был последним в фазе, переходим к следующей сразу.
+        На диск попадает только переход фазы, после перезапуска недостающие подтверждения добирает таймаут"""
+        advanced = []
+        with self._changed:
+            now = time.monotonic()
+            if now >= self._second_end:
+                return
+            for phase, pending in enumerate(self._pending):
+                if pending is None or device_hash not in pending:
+                    continue
+                pending.discard(device_hash)
+                if not pending and self._acked[phase] is None:
+                    self._acked[phase] = now
+                    advanced.append(phase)
+            if advanced:
+                self._recompute()
+                self._save()
+                self._changed.notify_all()
+        if advanced:
+            [listener() for listener in self.listeners]
+            report = self.report()
+            for phase in advanced:
+                logger.warning(f"Kill phase {phase + 1} acknowledged by all {self._expected[phase]} hosts "
+                               f"in {report['phases'][phase]['seconds']}s")
+
+    def _pending_count(self, phase):
+        return None if self._pending[phase] is None else len(self._pending[phase])
+
+    def report(self):
+        """Сколько на самом деле длились фазы последнего kill; seconds = None, пока фаза идет"""
+        if self._started is None:
+            return None
+        current_time = time.monotonic()
+        phases = []
+        for phase, (begin, end, timeout) in enumerate(zip((self._started, self._first_end),
+                                                          (self._first_end, self._second_end),
+                                                          (self.kill_first, self.kill_second))):
+            done = current_time >= end
+            acked = self._acked[phase] is not None and end - begin < timeout
+            phases.append({
+                "seconds": round(end - begin, 3) if done else None,
+                "by": ("ack" if acked else "timeout") if done else None,
+                "expected": self._expected[phase] if self._pending[phase] is not None else None,
+                "pending": self._pending_count(phase)
+            })
+        return {"started": self.history[-1], "phases": phases}
 
 
 def generate_hash(login, password, salt=''):
@@ -48,23 +202,18 @@ def generate_hash(login, password, salt=''):
 class Auth:
     login: str
     password: str
-    woraw: str = field(init=False)  # raw
-    wsolt: str = field(init=False)  # salt
+    digest: str = field(init=False, repr=False)  # Считается один раз при загрузке конфига
+
+    def __post_init__(self):
+        self.digest = generate_hash(self.login, self.password)
 
     def __eq__(self, other):
         if isinstance(other, Auth):
-            return generate_hash(self.login, self.password) == generate_hash(other.login, other.password)
+            return self.digest == other.digest
         if isinstance(other, str):
-            return generate_hash(self.login, self.password) == other
+            return self.digest == other
         if isinstance(other, (tuple, list)):
-            return generate_hash(self.login, self.password) == generate_hash(*other)
-
-    def generate_cookies(self, salt):
-        self.woraw = generate_hash(self.login, self.password)
-        self.wsolt = generate_hash(self.login, self.password, salt)
-
-    def check_cookies(self, woraw, wsolt):
-        return self.woraw == woraw and self.wsolt == wsolt
+            return self.digest == generate_hash(*other)
 
 @dataclass
 class Notify:
@@ -72,9 +221,10 @@ class Notify:
     template: str
 
     def render_template(self, time, host, status, act):
-        return self.template.format(time, host, status, act)
+        return self.template.format(time=time, host=host, status=status, act=act)
 
     def notify(self, message):
+        """Отправка сообщения; вернуть число секунд, если отправку надо повторить позже"""
         pass
 
 @dataclass
@@ -84,11 +234,17 @@ class Telegram(Notify):
     token: str
     chat_id: int
     settings: dict
+    api_url: str = "https://api.telegram.org"
+    timeout: float = 10
 
     def notify(self, message):
-        requests.post(
-            f"https://api.telegram.org/bot{self.token}/sendMessage",
-            data={"chat_id": self.chat_id, "text": message, **self.settings})
+        r = requests.post(
+            f"{self.api_url}/bot{self.token}/sendMessage",
+            data={"chat_id": self.chat_id, "text": message, **self.settings}, timeout=self.timeout)
+        if r.status_code == 429:
+            # Flood control: телеграм сам говорит, сколько ждать
+            return r.json().get("parameters", {}).get("retry_after", 30)
+        r.raise_for_status()
 
 
 
@@ -96,9 +252,18 @@ class Config:
     def __init__(self, file):
         self.config_file = Path(file)
         self.__config_raw = edict({
+            "server": {
+                "host": "0.0.0.0",
+                "port": 5000,
+                "mode": "flask",  # flask | asyncio
+                "session_ttl": 3600,
+                "workers": 1  # >1 - несколько процессов, нужен storage.backend = sqlite; история хостов недоступна
+            },
             "client": {
                 "update_interval": 43200,
-                "ping_interval": 60
+                "ping_interval": 60,
+                "wait_timeout": 30,
+                "retry_after": 10  # Через сколько секунд повторить запрос после ошибки сервера
             },
             "auth": [
                 {"login": "admin", "password": "P@ssw0rd"}
@@ -124,14 +289,48 @@ class Config:
                     "format": "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | <level>{message}</level>",
                     "level": "DEBUG",
                     "rotation": "10 MB",
-                    "retention": "30 day"
-                }
+                    "retention": "30 day",
+                    "enqueue": True  # Запись в файл в отдельном потоке, запросы ее не ждут
+                },
+                "summary_interval": 60,  # Пинги и прочие частые события - одной строкой раз в столько секунд
+                "repeat_interval": 300  # Повторяющиеся предупреждения по одному хосту/адресу - не чаще
             },
             "storage": {
+                "backend": "journal",  # journal | sqlite
                 "dir": "/etc/killer/",
-                "hosts": "hosts.json"
+                "hosts": "hosts.json",
+                "sqlite": "hosts.db",
+                "journal": "hosts.journal",
+                "kill_state": "kill.json",
+                "shared": "hosts.shm",  # Общая таблица воркеров
+                "shared_capacity": 65536,
+                "compact_every": 1000,
+                "flush_interval": 30
+            },
+            "replication": {
+                "enabled": False,
+                "self": "http://127.0.0.1:5000",  # Адрес этого сервера, как его видят соседи
+                "peers": [],  # Адреса остальных серверов
+                "priority": 0,  # 0 - основной; резервный с priority N ждет ведущего lease * (N + 1) секунд
+                "secret": "CHANGE_ME",
+                "lease": 10,
+                "interval": 1,
+                "log_size": 100000
+            },
+            "heartbeat": {
+                "enabled": False,
+                "port": 5000,  # UDP, может совпадать с портом HTTP
+                "secret": "CHANGE_ME"  # Из него и device_hash выводится ключ хоста
+            },
+            "lan": {
+                "enabled": False,  # Клиенты пересылают уведомление о kill соседям широковещательно
+                "port": 5056,  # UDP-порт клиентов
+                "secret": "CHANGE_ME"  # Из него выводится ключ подписи; клиентам уходит только открытый ключ
             },
             "notify": {
+                "window": 5,  # События за это время уходят одним сообщением
+                "min_interval": 3,
+                "retries": 5,
                 "telegram": {
                     "enabled": False,
                     "template": "Killer notification:\n"
@@ -143,7 +342,9 @@ class Config:
                     "chat_id": 0,
                     "settings": {
                         "parse_mode": "Markdown"
-                    }
+                    },
+                    "api_url": "https://api.telegram.org",
+                    "timeout": 10
                 }
             }
         })
@@ -158,22 +359,24 @@ class Config:
             print("File with configuration created.")
         try:
             _raw = json.loads(self.config_file.read_text("utf-8"))
-            self.__config_raw.update(_raw)
-            self.__config_raw['auth'] = _raw['auth']
-            self.__config_raw['delays'].update(_raw['delays'])
-            self.__config_raw['log'].update(_raw['log'])
-            self.__config_raw['storage'].update(_raw['storage'])
-            self.__config_raw['notify'].update(_raw['notify'])
+            self.__merge(self.__config_raw, _raw)
         except json.JSONDecodeError:
             print("Error while loading configuration file.")
             sys.exit(0)
         print("Configuration loaded.")
 
+    @classmethod
+    def __merge(cls, default, raw):
+        # Новые ключи по умолчанию не должны теряться, если в файле их еще нет
+        for k, v in raw.items():
+            if isinstance(v, dict) and isinstance(default.get(k), dict):
+                cls.__merge(default[k], v)
+            else:
+                default[k] = v
+
     def __prepare(self):
         # Готовим конфигурацию к использованию
         self.__config_raw['auth'] = list(map(lambda x: Auth(**x), self.__config_raw['auth']))
-        for a in self.__config_raw['auth']:
-            a.generate_cookies(self.secret_key)
         self.__config_raw['log']['file']['dir'] = Path(self.__config_raw['log']['file']['dir'])
         self.__config_raw['storage']['dir'] = Path(self.__config_raw['storage']['dir'])
         if platform.system() == "Linux":
@@ -184,10 +387,18 @@ class Config:
                 self.__config_raw['log']['file']['dir'].mkdir(parents=True, exist_ok=True)
             # storage
             self.__config_raw['storage']['hosts'] = self.__config_raw['storage']['dir'] / self.__config_raw['storage']['hosts']
+            self.__config_raw['storage']['journal'] = self.__config_raw['storage']['dir'] / self.__config_raw['storage']['journal']
+            self.__config_raw['storage']['sqlite'] = self.__config_raw['storage']['dir'] / self.__config_raw['storage']['sqlite']
+            self.__config_raw['storage']['kill_state'] = self.__config_raw['storage']['dir'] / self.__config_raw['storage']['kill_state']
+            self.__config_raw['storage']['shared'] = self.__config_raw['storage']['dir'] / self.__config_raw['storage']['shared']
             if not self.__config_raw['storage']['dir'].exists():
                 self.__config_raw['storage']['dir'].mkdir(parents=True, exist_ok=True)
         self.__config_raw['notify']['telegram'] = Telegram(**self.__config_raw['notify']['telegram'])
-        self.__config_raw['delays'] = Delays(**self.__config_raw['delays'])
+        self.__config_raw['delays'] = Delays(**self.__config_raw['delays'], state_file=self.__config_raw['storage']['kill_state'])
+
+    @property
+    def server(self):
+        return self.__config_raw['server']
 
     @property
     def client(self):
@@ -225,6 +436,18 @@ class Config:
     def storage(self):
         return self.__config_raw['storage']
 
+    @property
+    def replication(self):
+        return self.__config_raw['replication']
+
+    @property
+    def heartbeat(self):
+        return self.__config_raw['heartbeat']
+
+    @property
+    def lan(self):
+        return self.__config_raw['lan']
+
     @property
     def notify(self):
         return self.__config_raw['notify']
@@ -1,12 +1,19 @@
 import hashlib
-import json
+import heapq
 import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from pathlib import Path
 
 from loguru import logger
 
+from . import history
+from .history import History
+from .logs import hot
+from .storage import Storage
+
 class Host:
+    __slots__ = ("hostname", "device_hash", "ips", "macs", "server", "last_request", "last_update", "enable")
     _host_db = None
     inactive_timeout = timedelta(minutes=1, seconds=15)
 
@@ -28,7 +35,7 @@ class Host:
         self.generate_hash()
 
     def registered(self):
-        return self._host_db.get(self.device_hash) is not None
+        return self._host_db.known(self.device_hash)
 
     def save(self):
         if not self.registered():
@@ -46,10 +53,14 @@ class Host:
         if not self.enable:
             self.enable = True
             logger.info(f"[{self.hostname}] Host marked as active")
+            self._host_db.record(self.device_hash, history.ENABLED)
             [callback(self) for callback in HostDatabase.enable_callbacks]
+            return True
+        return False
 
     def update(self, hostname, ips, macs, server):
         """Обновление данных хоста"""
+        changed = (self.hostname, self.ips, self.macs, self.server) != (hostname, ips, macs, server)
         self._check_enable()
         self.hostname = hostname
         self.ips = ips
@@ -59,7 +70,10 @@ class Host:
         old_device_hash = self.device_hash
         self.generate_hash()
         self.ping()
-        logger.info(f"[datastore] Host data updated: {self}")
+        if changed:
+            logger.info(f"[datastore] Host data updated: {self}")
+        else:
+            hot.hit("updates", self.device_hash)
         if self.device_hash != old_device_hash:
             self._host_db.replace(old_device_hash, self)
         else:
@@ -68,10 +82,13 @@ class Host:
 
     def ping(self):
         """Обновление времени последнего запроса"""
-        self._check_enable()
+        enabled = self._check_enable()
         self.last_request = datetime.now(timezone.utc)
-        logger.info(f"[{self.hostname}] ping: {self.last_request}")
-        self.save()
+        hot.hit("pings", self.device_hash)
+        if enabled:
+            self.save()  # Изменилось состояние - пишем сразу
+        else:
+            self._host_db.touch(self)  # Только время - уйдет на диск пачкой
 
     def shutdown(self):
         """Хост сообщил о завершении работы"""
@@ -79,6 +96,7 @@ class Host:
             return # Хост уже отключен
         self.enable = False
         logger.info(f"[{self.hostname}] Host marked as inactive")
+        self._host_db.record(self.device_hash, history.SHUTDOWN)
         self.save()
         [callback(self) for callback in HostDatabase.shutdown_callbacks]
 
@@ -103,7 +121,6 @@ class Host:
             return line
         hostname, device_hash, ips, macs, server, last_request, last_update, enable = line
         host = cls(hostname, ips, macs, server, last_request, last_update, enable)
-        host.generate_hash()
         if device_hash != host.device_hash:
             logger.error(f"[datastore] Hash mismatch of host {hostname}: {device_hash} != {host.device_hash}")
         return host
@@ -126,7 +143,8 @@ class Host:
             "server": self.server,
             "last_request": self.last_request.timestamp(),
             "last_update": self.last_update.timestamp(),
-            "enable": self.enable
+            "enable": self.enable,
+            "active": self.is_active()
         }
 
     def __eq__(self, other):
@@ -140,82 +158,283 @@ class HostDatabase:
     inactive_callbacks = []
     shutdown_callbacks = []
     enable_callbacks = []
+    max_removed = 1024  # Сколько удалений помнить для дельт дашборда
+    history_size = 64  # Сколько переходов состояния помнить на хост
+    keeps_history = True
 
-    def __init__(self, data_file):
+    def __init__(self, storage: Storage, flush_interval=30):
         self.t = None
         self.run = True
-        self.file = Path(data_file)
-        self.data = {}  # hash: (hostname, device_hash, ips, macs, last_request, enable)
+        self.flush_interval = flush_interval
+        self.storage = storage
+        self.hosts = {}  # hash: Host; один живой объект на хост
+        self.liveness = set()  # hash хостов с еще не сброшенными на диск пингами
+        self._lock = threading.Lock()
+        self._deadlines = []  # heap: (last_request + inactive_timeout, hash)
+        self._inactive = set()  # hash хостов, о неактивности которых уже сообщили
+        self._wakeup = threading.Condition()
+        self.version = 0  # Растет на каждое изменение хоста
+        self._changes = OrderedDict()  # hash: version, по возрастанию версии
+        self._removed = OrderedDict()  # hash: version удаления
+        self._removed_floor = 0  # Удаления до этой версии забыты
+        self._versions = threading.Lock()
+        self.history = {}  # hash: History
+        self.expiring = True  # Резервный сервер (репликация) не объявляет хосты неактивными
         Host._host_db = self
         self._read()
 
     def _read(self):
-        if not self.file.exists():
-            self._write()
-        with open(self.file, "r", encoding="utf-8") as f:
-            self.data = json.load(f)
-        logger.success(f"[datastore] Loaded {len(self.all())} hosts")
-
-    def _write(self):
-        with open(self.file, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, indent=4)
+        # Хеши сверяются только здесь, дальше работаем с готовыми объектами
+        self.hosts = {device_hash: Host.from_tuple(line) for device_hash, line in self.storage.load().items()}
+        for host in self.hosts.values():
+            # До перезапуска истории нет: считаем, что хост был в сети на момент последнего запроса
+            self.record(host.device_hash, history.ACTIVE if host.enable else history.SHUTDOWN,
+                        host.last_request.timestamp())
+            self._schedule(host)
+        logger.success(f"[datastore] Loaded {len(self.hosts)} hosts")
+
+    def _schedule(self, host: Host):
+        """Постановка дедлайна неактивности хоста в очередь"""
+        if not host.enable:
+            return
+        deadline = host.last_request.timestamp() + Host.inactive_timeout.total_seconds()
+        with self._wakeup:
+            if host.device_hash in self._inactive:
+                self._inactive.discard(host.device_hash)
+                h = self.history.get(host.device_hash)
+                if h is not None and h.last() == history.INACTIVE:
+                    self.record(host.device_hash, history.ACTIVE)
+            heapq.heappush(self._deadlines, (deadline, host.device_hash))
+            if self._deadlines[0][1] == host.device_hash:
+                self._wakeup.notify()  # Новый ближайший дедлайн - будим проверку
+
+    def _pop_expired(self, now):
+        """Хосты, дедлайн которых наступил; устаревшие записи очереди просто выбрасываются"""
+        expired = []
+        timeout = Host.inactive_timeout.total_seconds()
+        with self._wakeup:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, device_hash = heapq.heappop(self._deadlines)
+                host = self.hosts.get(device_hash)
+                if host is None or not host.enable or device_hash in self._inactive:
+                    continue
+                if host.last_request.timestamp() + timeout > now:
+                    continue  # Хост пинговался, в очереди уже есть более поздний дедлайн
+                self._inactive.add(device_hash)
+                self.record(device_hash, history.INACTIVE, now)
+                self._changed(device_hash)
+                expired.append(host)
+        return expired
+
+    def _changed(self, device_hash, removed=False):
+        """Новая версия для хоста"""
+        with self._versions:
+            self.version += 1
+            if removed:
+                self._changes.pop(device_hash, None)
+                self._removed[device_hash] = self.version
+                if len(self._removed) > self.max_removed:
+                    _, self._removed_floor = self._removed.popitem(last=False)
+                return
+            self._removed.pop(device_hash, None)
+            self._changes[device_hash] = self.version
+            self._changes.move_to_end(device_hash)
+
+    def record(self, device_hash, event, ts=None):
+        """Переход состояния хоста в его историю"""
+        h = self.history.get(device_hash)
+        if h is None:
+            h = self.history[device_hash] = History(self.history_size)
+        h.add(event, datetime.now(timezone.utc).timestamp() if ts is None else ts)
+
+    def uptime(self, device_hash, window: timedelta):
+        """Доступность хоста за окно: {uptime, observed, flaps, history}"""
+        h = self.history.get(device_hash)
+        if h is None:
+            return None
+        now = datetime.now(timezone.utc).timestamp()
+        since = now - window.total_seconds()
+        up, observed, flaps = h.uptime(since, now)
+        return {"uptime": round(up / observed, 4) if observed else None, "up_seconds": int(up),
+                "observed_seconds": int(observed), "flaps": flaps, "history": h.timeline(since)}
+
+    def changes(self, since=None):
+        """Хосты, изменившиеся после версии since: (version, hosts, removed hashes, full)"""
+        with self._versions:
+            version = self.version
+            if since is None or since > version or since < self._removed_floor:
+                return version, list(self.hosts.values()), [], True
+            device_hashes = []
+            for device_hash, v in reversed(self._changes.items()):
+                if v <= since:
+                    break
+                device_hashes.append(device_hash)
+            removed = []
+            for device_hash, v in reversed(self._removed.items()):
+                if v <= since:
+                    break
+                removed.append(device_hash)
+        return version, list(filter(None, map(self.hosts.get, device_hashes))), removed, False
+
+    def _set(self, host: Host):
+        self.hosts[host.device_hash] = host
+        self.liveness.discard(host.device_hash)
+        self.storage.set(host.device_hash, host.to_tuple())
+        self._changed(host.device_hash)
+        self._schedule(host)
+
+    def touch(self, host: Host):
+        """Пинг хоста: только в памяти, на диск попадет при flush()"""
+        if host.device_hash not in self.hosts:
+            return
+        with self._lock:  # flush() подменяет и перебирает liveness
+            self.liveness.add(host.device_hash)
+        self._changed(host.device_hash)
+        self._schedule(host)
+
+    def flush(self):
+        """Сброс накопленных пингов на диск одной записью"""
+        with self._lock:
+            if not self.liveness:
+                return
+            liveness, self.liveness = self.liveness, set()
+            pings = {}
+            for device_hash in liveness:
+                host = self.hosts.get(device_hash)
+                if host is not None:
+                    pings[device_hash] = int(host.last_request.timestamp())
+        # Без _lock: пинги не ждут диска. Пачка может лечь позже более нового set - хранилища и реплики
+        # применяют touch как max(last_request), так что время хоста назад не отматывается
+        self.storage.touch(pings)
+        logger.debug(f"[datastore] Flushed {len(pings)} pings")
+
+    def _compact(self):
+        """Свертка журнала в снапшот"""
+        self.flush()
+        if not self.storage.snapshots:
+            return
+        with self._lock:
+            data = {device_hash: host.to_tuple() for device_hash, host in self.hosts.items()}
+            self.storage.rotate()
+        self.storage.write_snapshot(data)
 
     def _check_clients(self):
-        _sleep_parts = [0] * int(Host.inactive_timeout.total_seconds())
+        next_flush = time.monotonic() + self.flush_interval
         while self.run:
-            for host in self.find_inactive():
+            for host in self._pop_expired(datetime.now(timezone.utc).timestamp()):
+                if not self.expiring:
+                    continue
                 logger.warning(f"Host {host.hostname!r} is inactive")
                 [callback(host) for callback in self.inactive_callbacks]
-            for _ in _sleep_parts:
-                threading.Event().wait(1)  # Пауза между проверками
-                if not self.run:
-                    return
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+            if self.storage.need_compact():
+                self._compact()
+            with self._wakeup:
+                # Спим до ближайшего дедлайна или сброса пингов
+                timeout = next_flush - time.monotonic()
+                if self._deadlines:
+                    timeout = min(timeout, self._deadlines[0][0] - datetime.now(timezone.utc).timestamp())
+                if self.run and timeout > 0:
+                    self._wakeup.wait(timeout)
 
     def get(self, device_hash):
-        host = self.data.get(device_hash)
-        return Host.from_tuple(host)
+        return self.hosts.get(device_hash)
+
+    def known(self, device_hash):
+        return device_hash in self.hosts
 
     def add(self, host: Host):
-        if self.data.get(host.device_hash):
-            return
         if host.device_hash is None:
             host.generate_hash()
-        self.data[host.device_hash] = host.to_tuple()
+        if self.known(host.device_hash):
+            return
+        with self._lock:
+            self.record(host.device_hash, history.REGISTERED)
+            self._set(host)
         logger.info(f"[datastore] Add new host: {host}")
-        self._write()
 
     def update(self, host: Host):
-        if self.data.get(host.device_hash) is None:
+        if not self.known(host.device_hash):
             return
-        self.data[host.device_hash] = host.to_tuple()
-        self._write()
+        with self._lock:
+            self._set(host)
 
     def replace(self, old_device_hash, new_host: Host):
-        if self.data.get(old_device_hash) is None:
+        if old_device_hash not in self.hosts:
             return
-        self.data.pop(old_device_hash)
-        self.data[new_host.device_hash] = new_host.to_tuple()
+        with self._lock:
+            self.hosts.pop(old_device_hash)
+            self.liveness.discard(old_device_hash)
+            self.storage.delete(old_device_hash)
+            self._changed(old_device_hash, removed=True)
+            if old_device_hash in self.history:
+                self.history[new_host.device_hash] = self.history.pop(old_device_hash)
+            with self._wakeup:
+                if old_device_hash in self._inactive:
+                    self._inactive.discard(old_device_hash)
+                    self._inactive.add(new_host.device_hash)
+            self._set(new_host)
         logger.info(f"[datastore] device_hash replaced for {new_host.hostname!r}: {old_device_hash} -> {new_host.device_hash}")
-        self._write()
+
+    def apply(self, op, *args):
+        """Изменение от ведущего сервера: то же, что пишется в хранилище, но без колбэков"""
+        with self._lock:
+            match op:
+                case "set":
+                    self._set(Host.from_tuple(args[0]))
+                case "del":
+                    if self.hosts.pop(args[0], None) is not None:
+                        self.liveness.discard(args[0])
+                        self.storage.delete(args[0])
+                        self._changed(args[0], removed=True)
+                case "touch":
+                    for device_hash, last_request in args[0].items():
+                        host = self.hosts.get(device_hash)
+                        last_request = datetime.fromtimestamp(last_request, timezone.utc)
+                        if host is None or last_request <= host.last_request:
+                            continue  # Пачка пингов старше уже примененного set
+                        host.last_request = last_request
+                        self.liveness.add(device_hash)
+                        self._changed(device_hash)
+                        self._schedule(host)
+
+    def apply_snapshot(self, data: dict):
+        """Полная копия хостов ведущего: {device_hash: line}"""
+        for device_hash in set(self.hosts) - set(data):
+            self.apply("del", device_hash)
+        for line in data.values():
+            self.apply("set", line)
+
+    def snapshot(self):
+        with self._lock:
+            return {device_hash: host.to_tuple() for device_hash, host in self.hosts.items()}
+
+    def grace(self):
+        """Новый ведущий: пинги могли не успеть дойти, у каждого включенного хоста - полный таймаут с этого момента"""
+        deadline = datetime.now(timezone.utc).timestamp() + Host.inactive_timeout.total_seconds()
+        with self._wakeup:
+            self._inactive.clear()
+            self._deadlines = [(deadline, device_hash) for device_hash, host in self.hosts.items() if host.enable]
+            heapq.heapify(self._deadlines)
+            self._wakeup.notify()
 
     def all(self, _asdict=False):
-        data = list(map(Host.from_tuple, self.data.values()))
+        data = list(self.hosts.values())
         if not _asdict:
             return data
         return [host.to_dict() for host in data]
 
-    def find_inactive(self):
-        for host in self.all():
-            if not host.enable:
-                continue
-            if not host.is_active():
-                yield host
-
     def start_checking(self):
         self.t = threading.Thread(target=self._check_clients)
         self.t.start()
 
     def stop_checking(self):
         self.run = False
+        with self._wakeup:
+            self._wakeup.notify()
         self.t.join()
         self.t = None
+        self._compact()
+        self.storage.close()
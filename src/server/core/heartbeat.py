@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import socket
+import struct
+import threading
+
+from loguru import logger
+
+MAGIC = b"KH\x01"
+REQUEST = struct.Struct("!3s32sQ")  # magic, device_hash (32 байта), счетчик клиента
+REPLY = struct.Struct("!3sBQH")  # magic, флаги, счетчик из запроса, next_ping в десятых долях секунды
+MAC_SIZE = 16
+KILL_FIRST, KILL_SECOND, UNKNOWN, NOT_LEADER = 1, 2, 4, 8
+
+
+def host_key(secret, device_hash):
+    """Ключ хоста для подписи датаграмм; клиент получает его в ответе на update"""
+    return hmac.new(secret.encode(), device_hash.encode(), hashlib.sha256).digest()
+
+
+def sign(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def open_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    return sock
+
+
+class Heartbeat:
+    """UDP-пинги: датаграмма с device_hash и счетчиком, подписанная ключом хоста; в ответ - статус kill"""
+
+    def __init__(self, api, secret, sock):
+        self.api = api
+        self.secret = secret
+        self.sock = sock
+        self._counters = {}  # device_hash: последний принятый счетчик, повторы отбрасываем
+        self.run = True
+        self.t = None
+
+    def handle(self, data):
+        """Ответ на датаграмму или None, если она не наша или подпись не сходится"""
+        if len(data) != REQUEST.size + MAC_SIZE:
+            return None
+        magic, raw_hash, counter = REQUEST.unpack_from(data)
+        if magic != MAGIC:
+            return None
+        device_hash = raw_hash.hex()
+        key = host_key(self.secret, device_hash)
+        if not hmac.compare_digest(sign(key, data[:REQUEST.size]), data[REQUEST.size:]):
+            return None
+        if not self._fresh(device_hash, counter):
+            return None
+        flags, next_ping = self.api.heartbeat(device_hash)
+        if not flags & (UNKNOWN | NOT_LEADER):
+            self._accept(device_hash, counter)
+        reply = REPLY.pack(MAGIC, flags, counter, min(int(next_ping * 10), 0xFFFF))
+        return reply + sign(key, reply)
+
+    def _fresh(self, device_hash, counter):
+        return counter > self._counters.get(device_hash, 0)
+
+    def _accept(self, device_hash, counter):
+        self._counters[device_hash] = counter
+
+    def _loop(self):
+        while self.run:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                reply = self.handle(data)
+                if reply is not None:
+                    self.sock.sendto(reply, addr)
+            except Exception as e:
+                logger.exception(f"[heartbeat] {e}")
+
+    def start(self):
+        self.sock.settimeout(1)
+        self.t = threading.Thread(target=self._loop, daemon=True)
+        self.t.start()
+        logger.info(f"[heartbeat] Listening on udp {self.sock.getsockname()}")
+
+    def stop(self):
+        self.run = False
+        if self.t is not None:
+            self.t.join(5)
+            self.t = None
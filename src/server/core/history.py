@@ -0,0 +1,59 @@
+from array import array
+
+REGISTERED, ACTIVE, INACTIVE, SHUTDOWN, ENABLED = range(5)
+EVENTS = ("registered", "active", "inactive", "shutdown", "enabled")
+_UP = {REGISTERED, ACTIVE, ENABLED}
+
+
+class History:
+    """Кольцевой буфер переходов состояния хоста: время (uint32) + код события (uint8)"""
+    __slots__ = ("times", "events", "pos", "count")
+
+    def __init__(self, size):
+        self.times = array('I', bytes(4 * size))
+        self.events = array('B', bytes(size))
+        self.pos = 0  # Куда писать следующее событие
+        self.count = 0
+
+    def add(self, event, ts):
+        self.times[self.pos] = int(ts)
+        self.events[self.pos] = event
+        self.pos = (self.pos + 1) % len(self.events)
+        self.count = min(self.count + 1, len(self.events))
+
+    def last(self):
+        if not self.count:
+            return None
+        return self.events[self.pos - 1]
+
+    def __iter__(self):
+        """(время, событие) от старых к новым"""
+        size = len(self.events)
+        start = (self.pos - self.count) % size
+        for i in range(self.count):
+            j = (start + i) % size
+            yield self.times[j], self.events[j]
+
+    def timeline(self, since=0):
+        return [{"time": ts, "event": EVENTS[event]} for ts, event in self if ts >= since]
+
+    def uptime(self, since, now):
+        """(секунды онлайн, секунды наблюдения, переходы в оффлайн) на отрезке [since, now]"""
+        up = observed = flaps = 0
+        prev_ts, prev_up = None, None
+        for ts, event in self:
+            is_up = event in _UP
+            if ts > since and prev_ts is not None:
+                start = max(prev_ts, since)
+                observed += ts - start
+                if prev_up:
+                    up += ts - start
+            if ts >= since and prev_up and not is_up:
+                flaps += 1
+            prev_ts, prev_up = ts, is_up
+        if prev_ts is not None and now > since:
+            start = max(prev_ts, since)
+            observed += now - start
+            if prev_up:
+                up += now - start
+        return up, observed, flaps
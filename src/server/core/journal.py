@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+from .storage import Storage
+
+
+class Journal(Storage):
+    """Хранилище хостов: снапшот (hosts.json) + дописываемый журнал изменений"""
+    snapshots = True
+
+    def __init__(self, snapshot_file, journal_file, compact_every=1000):
+        self.snapshot_file = Path(snapshot_file)
+        self.journal_file = Path(journal_file)
+        self.rotated_file = self.journal_file.with_name(self.journal_file.name + ".1")
+        self.compact_every = compact_every
+        self.records = 0  # Записей в журнале с последнего снапшота
+        self._f = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        """Чтение снапшота и проигрывание журнала поверх него"""
+        data = {}
+        if self.snapshot_file.exists():
+            with open(self.snapshot_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        replayed = 0
+        # .1 - журнал, снапшот которого не успели дописать
+        for file in (self.rotated_file, self.journal_file):
+            if not file.exists():
+                continue
+            with open(file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Запись оборвалась на середине (падение во время записи) - дальше ничего нет
+                        logger.warning(f"[journal] Broken record skipped: {line!r}")
+                        break
+                    self._apply(data, record)
+                    replayed += 1
+        if replayed:
+            logger.info(f"[journal] Replayed {replayed} records")
+        # Все уже в памяти: пишем снапшот и начинаем с чистого журнала
+        self.write_snapshot(data)
+        with self._lock:
+            self._f = open(self.journal_file, "w", encoding="utf-8")
+            self.records = 0
+        return data
+
+    @staticmethod
+    def _apply(data, record):
+        match record['op']:
+            case "set":
+                data[record['hash']] = record['host']
+            case "del":
+                data.pop(record['hash'], None)
+            case "touch":
+                for device_hash, last_request in record['host'].items():
+                    line = data.get(device_hash)
+                    if line is not None:
+                        # Пачка пингов могла лечь в журнал после более нового set - время назад не отматываем
+                        line[5] = max(line[5], last_request)
+            case _:
+                logger.error(f"[journal] Unknown record: {record}")
+
+    def _open(self):
+        if self._f is None:
+            self._f = open(self.journal_file, "a", encoding="utf-8")
+        return self._f
+
+    def append(self, op, device_hash, host=None):
+        """Запись одного изменения в конец журнала (для touch в host - {hash: last_request})"""
+        record = {"op": op}
+        if device_hash is not None:
+            record['hash'] = device_hash
+        if host is not None:
+            record['host'] = host
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            f = self._open()
+            f.write(line)
+            f.flush()
+            self.records += 1
+
+    def set(self, device_hash, line):
+        self.append("set", device_hash, line)
+
+    def delete(self, device_hash):
+        self.append("del", device_hash)
+
+    def touch(self, pings: dict):
+        self.append("touch", None, pings)
+
+    def need_compact(self):
+        return self.records >= self.compact_every
+
+    def rotate(self):
+        """Начало нового журнала; старый живет до записи снапшота"""
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            if self.journal_file.exists():
+                os.replace(self.journal_file, self.rotated_file)
+            self._f = open(self.journal_file, "w", encoding="utf-8")
+            self.records = 0
+
+    def write_snapshot(self, data):
+        """Атомарная запись снапшота, после чего старый журнал больше не нужен"""
+        tmp = self.snapshot_file.with_name(self.snapshot_file.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_file)
+        self.rotated_file.unlink(missing_ok=True)
+        logger.debug(f"[journal] Snapshot written: {len(data)} hosts")
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
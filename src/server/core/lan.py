@@ -0,0 +1,34 @@
+import hashlib
+import struct
+
+from loguru import logger
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:  # Без cryptography уведомления для LAN не выпускаются
+    Ed25519PrivateKey = None
+
+MAGIC = b"KK\x02"
+NOTICE = struct.Struct("!3sBQQ")  # magic, флаги kill (как в heartbeat), начало kill, до когда действует (unix time)
+SIG_SIZE = 64  # Подпись Ed25519
+
+
+def fleet_key(secret):
+    """Закрытый ключ Ed25519 для подписи уведомлений о kill или None, если подписывать нечем.
+    Выводится из lan.secret (у всех воркеров и реплик один и тот же) и не покидает сервер:
+    клиенты получают только открытый ключ и подделать уведомление не могут"""
+    if Ed25519PrivateKey is None:
+        logger.error("[lan] lan.enabled requires the cryptography package, LAN kill notices are disabled")
+        return None
+    return Ed25519PrivateKey.from_private_bytes(hashlib.sha256(secret.encode() + b"killer-lan").digest())
+
+
+def public_key(key):
+    """Открытый ключ для клиентов: 32 байта"""
+    return key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def kill_notice(key, flags, started, expires):
+    notice = NOTICE.pack(MAGIC, flags, int(started), int(expires))
+    return notice + key.sign(notice)
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from loguru import logger
+
+
+class HotLog:
+    """Частые события хостов: вместо строки на каждый пинг - сводка раз в interval секунд,
+    одинаковые сообщения по одному ключу - не чаще раза в repeat секунд"""
+
+    def __init__(self, interval=60, repeat=300):
+        self.interval = interval
+        self.repeat = repeat
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._hosts = set()
+        self._started = time.monotonic()
+        self._last = {}  # key: (когда писали, сколько пропустили с тех пор)
+        self._swept = self._started  # Когда последний раз выбрасывали из _last истекшие ключи
+
+    def configure(self, interval, repeat):
+        self.interval = interval
+        self.repeat = repeat
+
+    def hit(self, event, device_hash=None):
+        """Событие только в сводку; сводка пишется первым событием после конца интервала"""
+        now = time.monotonic()
+        with self._lock:
+            self._counts[event] += 1
+            if device_hash is not None:
+                self._hosts.add(device_hash)
+            if now - self._started < self.interval:
+                return
+            summary = self._take(now)
+        logger.info(summary)
+
+    def _take(self, now):
+        counts, hosts, elapsed = self._counts, len(self._hosts), now - self._started
+        self._counts, self._hosts, self._started = Counter(), set(), now
+        events = ", ".join(f"{count} {event}" for event, count in counts.most_common())
+        return f"[stats] {hosts} hosts in {elapsed:.0f}s: {events}"
+
+    def flush(self):
+        with self._lock:
+            if not self._counts:
+                return
+            summary = self._take(time.monotonic())
+        logger.info(summary)
+
+    def limited(self, key, level, message, *args):
+        """logger.log(level, message, *args), но по одному key не чаще раза в repeat секунд.
+        Форматирование отложено: пропущенное сообщение ничего не стоит"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._swept >= self.repeat:
+                # Ключи - в том числе адреса клиентов; без чистки словарь растет без предела
+                self._last = {k: v for k, v in self._last.items() if now - v[0] < self.repeat}
+                self._swept = now
+            last, skipped = self._last.get(key, (None, 0))
+            if last is not None and now - last < self.repeat:
+                self._last[key] = (last, skipped + 1)
+                return
+            self._last[key] = (now, 0)
+        if skipped:
+            message += f" ({skipped} similar suppressed)"
+        logger.log(level, message, *args)
+
+
+class AccessFilter(logging.Filter):
+    """Access-лог werkzeug: успешные запросы клиентов идут в сводку, а не строкой каждый"""
+
+    def __init__(self, hot_log):
+        super().__init__()
+        self.hot_log = hot_log
+
+    def filter(self, record):
+        args = record.args
+        if isinstance(args, tuple) and len(args) >= 2 and str(args[0]).startswith("POST /client ") and "200" in str(args[1]):
+            self.hot_log.hit("requests")
+            return False
+        return True
+
+
+hot = HotLog()
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from loguru import logger
+
+
+class Dispatcher:
+    """Очередь уведомлений: события за окно склеиваются в одно сообщение, отправка - в своем потоке"""
+
+    def __init__(self, notifiers, window=5, min_interval=3, retries=5, max_hosts=20):
+        self.notifiers = notifiers
+        self.window = window  # Сколько секунд копим события после первого
+        self.min_interval = min_interval  # Не чаще одного сообщения за столько секунд
+        self.retries = retries
+        self.max_hosts = max_hosts  # Сколько имен хостов перечислять в сводке
+        self.queue = queue.Queue()
+        self.t = None
+        self.run = True
+        self._last_send = 0.0
+
+    def push(self, host, status, act):
+        """Не блокирует: вызывается из потоков запросов и проверки хостов"""
+        if not self.notifiers:
+            return
+        self.queue.put((datetime.now(timezone.utc), host.hostname, status, act))
+
+    def _collect(self):
+        """Первое событие и все, что пришло за окно после него"""
+        try:
+            events = [self.queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.window
+        while (left := deadline - time.monotonic()) > 0:
+            try:
+                events.append(self.queue.get(timeout=left))
+            except queue.Empty:
+                break
+        return events
+
+    def _render(self, notifier, events):
+        if len(events) == 1:
+            return notifier.render_template(*events[0])
+        groups = {}
+        for _, hostname, status, act in events:
+            groups.setdefault((status, act), []).append(hostname)
+        lines = [f"Killer notification: {len(events)} events", f"  {events[0][0]} - {events[-1][0]}"]
+        for (status, act), hostnames in groups.items():
+            names = ", ".join(f"`{h}`" for h in hostnames[:self.max_hosts])
+            if len(hostnames) > self.max_hosts:
+                names += f" (+{len(hostnames) - self.max_hosts})"
+            lines.append(f"  {status} ({act}), {len(hostnames)}: {names}")
+        return "\n".join(lines)
+
+    def _send(self, notifier, message):
+        delay = 1
+        for attempt in range(self.retries):
+            wait = self._last_send + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_send = time.monotonic()
+            try:
+                retry_after = notifier.notify(message)
+            except Exception as e:
+                logger.warning(f"[notify] {type(notifier).__name__} failed ({attempt + 1}/{self.retries}): {e}")
+                retry_after = delay
+                delay *= 2
+            if not retry_after:
+                return True
+            time.sleep(retry_after)
+        logger.error(f"[notify] Message dropped after {self.retries} attempts: {message!r}")
+        return False
+
+    def _dispatch(self):
+        while self.run or not self.queue.empty():
+            events = self._collect()
+            if not events:
+                continue
+            for notifier in self.notifiers:
+                self._send(notifier, self._render(notifier, events))
+
+    def start(self):
+        self.t = threading.Thread(target=self._dispatch, daemon=True)
+        self.t.start()
+
+    def stop(self):
+        self.run = False
+        if self.t is not None:
+            self.t.join(self.window + 10)
+            self.t = None
@@ -0,0 +1,220 @@
+import hmac
+import itertools
+import threading
+import time
+from collections import deque
+
+import requests
+from loguru import logger
+
+from .storage import Storage
+
+
+class ReplicatedStorage(Storage):
+    """Хранилище ведущего сервера: каждая запись еще и попадает в журнал репликации"""
+
+    def __init__(self, storage: Storage, replicator):
+        self.storage = storage
+        self.replicator = replicator
+        self.snapshots = storage.snapshots
+
+    def load(self) -> dict:
+        return self.storage.load()
+
+    def get(self, device_hash):
+        return self.storage.get(device_hash)
+
+    def set(self, device_hash, line):
+        self.storage.set(device_hash, line)
+        self.replicator.record("set", line)
+
+    def delete(self, device_hash):
+        self.storage.delete(device_hash)
+        self.replicator.record("del", device_hash)
+
+    def touch(self, pings: dict):
+        self.storage.touch(pings)
+        self.replicator.record("touch", pings)
+
+    def need_compact(self):
+        return self.storage.need_compact()
+
+    def rotate(self):
+        self.storage.rotate()
+
+    def write_snapshot(self, data):
+        self.storage.write_snapshot(data)
+
+    def close(self):
+        self.storage.close()
+
+
+class Replicator:
+    """Ведущий/резервные серверы. Резервные раз в interval забирают у ведущего журнал изменений
+    (или полную копию), и если ведущий молчит дольше lease * (1 + priority) - становятся ведущим сами.
+    Из двух ведущих остается тот, у кого больше term (при равных - меньше priority)"""
+    batch = 5000  # Записей журнала за один ответ
+
+    def __init__(self, replication):
+        self.me = replication.self.rstrip("/")
+        self.peers = [peer.rstrip("/") for peer in replication.peers if peer.rstrip("/") != self.me]
+        self.priority = replication.priority
+        self.secret = replication.secret
+        self.lease = replication.lease
+        self.interval = replication.interval
+        self.host_db = None
+        self.delays = None
+
+        self.leader = False
+        self.leader_url = None
+        self.term = 0
+        self.log = deque(maxlen=replication.log_size)  # (seq, op, args)
+        self.seq = 0
+        self.cursor = None  # [term, seq] ведущего, до которого мы дошли
+        self.last_contact = time.monotonic()
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.t = None
+        self.run = True
+
+    def attach(self, host_db, delays):
+        self.host_db = host_db
+        self.delays = delays
+        self.host_db.expiring = False
+        delays.listeners.append(self._on_kill)
+
+    def record(self, op, *args):
+        if not self.leader:
+            return
+        with self._lock:
+            self.seq += 1
+            self.log.append((self.seq, op, args))
+
+    def _on_kill(self):
+        state = self.delays.state()
+        if state is not None:
+            self.record("kill", state)
+
+    def check_secret(self, secret):
+        return hmac.compare_digest((secret or "").encode(), self.secret.encode())
+
+    def handle(self, data):
+        """Ответ соседу: кто ведущий, и, если ведущий мы, - журнал после since"""
+        data = data or {}
+        if self.leader and isinstance(data.get('term'), int) and data['term'] > self.term:
+            self.step_down(None, data['term'])  # Кто-то уже видел ведущего новее нас
+        r = {"role": "leader" if self.leader else "standby", "term": self.term,
+             "priority": self.priority, "leader": self.leader_url}
+        if self.leader and data.get('since', False) is not False:
+            r.update(self._entries(data['since']))
+        return r
+
+    def _entries(self, since):
+        with self._lock:
+            first = self.log[0][0] if self.log else self.seq + 1
+            if since is not None and since[0] == self.term and first - 1 <= since[1] <= self.seq:
+                start = since[1] - first + 1
+                entries = list(itertools.islice(self.log, start, start + self.batch))
+                return {"seq": entries[-1][0] if entries else self.seq, "entries": entries,
+                        "more": start + self.batch < len(self.log)}
+            seq = self.seq
+        # Соседа нет в журнале (новый, отстал или другой term) - отдаем полную копию
+        return {"seq": seq, "entries": [], "more": False,
+                "snapshot": {"hosts": self.host_db.snapshot(), "kill": self.delays.state()}}
+
+    def _post(self, peer, data):
+        try:
+            r = self.session.post(f"{peer}/replication", json=data, headers={"X-Killer-Secret": self.secret},
+                                  timeout=max(self.interval, 1) * 5)
+            return r.json() if r.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    def _apply(self, r):
+        snapshot = r.get('snapshot')
+        if snapshot is not None:
+            self.host_db.apply_snapshot(snapshot['hosts'])
+            if snapshot['kill'] is not None:
+                self.delays.restore(snapshot['kill'])
+            logger.info(f"[replication] Snapshot from {self.leader_url}: {len(snapshot['hosts'])} hosts")
+        for _, op, args in r['entries']:
+            if op == "kill":
+                self.delays.restore(args[0])
+            else:
+                self.host_db.apply(op, *args)
+        self.cursor = [r['term'], r['seq']]
+        return r.get('more', False)
+
+    def promote(self):
+        with self._lock:
+            self.term += 1
+            self.leader = True
+            self.leader_url = self.me
+            self.log.clear()
+            self.seq = 0
+        self.host_db.grace()
+        self.host_db.expiring = True
+        logger.warning(f"[replication] {self.me} is now the leader (term {self.term})")
+
+    def step_down(self, leader_url, term):
+        with self._lock:
+            self.leader = False
+            self.leader_url = leader_url
+            self.term = max(self.term, term)
+            self.cursor = None
+        self.host_db.expiring = False
+        self.last_contact = time.monotonic()
+        logger.warning(f"[replication] {self.me} follows {leader_url} (term {term})")
+
+    def _lead(self):
+        for peer in self.peers:
+            r = self._post(peer, {"term": self.term})
+            if r is None or r['role'] != "leader":
+                continue
+            if (r['term'], -r['priority']) > (self.term, -self.priority):
+                self.step_down(peer, r['term'])
+                return
+
+    def _follow(self):
+        candidates = [self.leader_url] + [peer for peer in self.peers if peer != self.leader_url]
+        for peer in filter(None, candidates):
+            r = self._post(peer, {"term": self.term, "since": self.cursor})
+            if r is None:
+                continue
+            self.term = max(self.term, r['term'])
+            if r['role'] != "leader":
+                continue
+            if self.leader_url != peer:
+                self.leader_url = peer  # У нового ведущего новый term - он сам отдаст полную копию
+                logger.info(f"[replication] Leader: {peer} (term {r['term']})")
+            self.last_contact = time.monotonic()
+            while self._apply(r) and self.run:
+                r = self._post(peer, {"term": self.term, "since": self.cursor})
+                if r is None or r['role'] != "leader":
+                    break
+            return
+        if time.monotonic() - self.last_contact > self.lease * (1 + self.priority):
+            self.promote()
+
+    def _loop(self):
+        # Первый на очереди сервер не ждет аренду, если ведущего нет
+        if self.priority == 0:
+            self._follow()
+            if not self.leader and self.leader_url is None:
+                self.promote()
+        while self.run:
+            try:
+                self._lead() if self.leader else self._follow()
+            except Exception as e:
+                logger.exception(f"[replication] {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        self.t = threading.Thread(target=self._loop, daemon=True)
+        self.t.start()
+
+    def stop(self):
+        self.run = False
+        if self.t is not None:
+            self.t.join(self.interval * 5 + 5)
+            self.t = None
@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class Sessions:
+    """Сессии админки: случайный токен -> пользователь, с истечением через ttl секунд"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # token: (user, expires); порядок создания = порядок истечения
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._sessions:
+            token, (_, expires) = next(iter(self._sessions.items()))
+            if expires > now:
+                break
+            del self._sessions[token]
+
+    def create(self, user):
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            self._sessions[token] = (user, now + self.ttl)
+        return token
+
+    def get(self, token):
+        """Пользователь сессии или None"""
+        if not token:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(token)
+        return None if session is None else session[0]
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SignedSessions(Sessions):
+    """Сессии для воркеров prefork без общего хранилища: токен сам несет логин и срок, подписан HMAC"""
+
+    def __init__(self, key, users, ttl=3600):
+        super().__init__(ttl)
+        self.key = key.encode()
+        self.users = {user.login: user for user in users}
+
+    def _sign(self, payload):
+        return hmac.new(self.key, payload.encode(), hashlib.sha256).hexdigest()
+
+    def create(self, user):
+        login = base64.urlsafe_b64encode(user.login.encode()).decode()
+        payload = f"{login}.{int(time.time() + self.ttl)}.{secrets.token_urlsafe(8)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def get(self, token):
+        if not token or token.count(".") != 3:
+            return None
+        payload, _, sign = token.rpartition(".")
+        if not hmac.compare_digest(self._sign(payload), sign):
+            return None
+        login, expires, _ = payload.split(".")
+        if not expires.isdigit() or int(expires) <= time.time():
+            return None
+        try:
+            return self.users.get(base64.urlsafe_b64decode(login).decode())
+        except ValueError:
+            return None
+
+    def __len__(self):
+        return 0
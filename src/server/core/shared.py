@@ -0,0 +1,501 @@
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from loguru import logger
+
+from .config import Delays
+from .datastore import Host, HostDatabase
+from .heartbeat import Heartbeat
+
+_MAGIC = b"KILLSHM1"
+# magic, capacity, count, version, generation, started, acked[2], expected[2], pending[2]
+_HEADER = struct.Struct("<8sIIQQ3d4i")
+_HEADER_SIZE = 128
+_COUNT = 12
+_VERSION = 16
+_GENERATION = 24
+# hash (sha256), last_request, revision (метаданные в хранилище), flags, version, счетчик heartbeat
+_RECORD = struct.Struct("<32sdIIQQ")
+_RECORD_SIZE = 64
+
+USED, ENABLE, INACTIVE, REMOVED, EXPECT_APP, EXPECT_ALL = (1 << i for i in range(6))
+_EXPECT = (EXPECT_APP, EXPECT_ALL)
+
+
+class SharedTable:
+    """Таблица хостов в mmap-файле, общая для воркеров: время пинга, флаги и состояние kill.
+    Записи и заголовок защищены fcntl-блокировками по диапазону байт (между процессами)
+    и threading-блокировками (fcntl-блокировки у потоков одного процесса общие)"""
+    stripes = 64
+
+    def __init__(self, file, capacity=65536):
+        self.file = Path(file)
+        self.capacity = capacity
+        self.size = _HEADER_SIZE + capacity * _RECORD_SIZE
+        self.fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size != self.size:
+            os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size)
+        self._header_lock = threading.Lock()
+        self._record_locks = [threading.Lock() for _ in range(self.stripes)]
+        self.index = {}  # hash: номер записи; у каждого процесса свой, дочитывается по count
+        self._scanned = 0
+
+    @contextmanager
+    def _locked(self, lock, offset, length):
+        with lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def _header(self):
+        return self._locked(self._header_lock, 0, _HEADER_SIZE)
+
+    def _record(self, slot):
+        return self._locked(self._record_locks[slot % self.stripes], _HEADER_SIZE + slot * _RECORD_SIZE, _RECORD_SIZE)
+
+    @staticmethod
+    def _offset(slot):
+        return _HEADER_SIZE + slot * _RECORD_SIZE
+
+    def reset(self):
+        """Пустая таблица; начатый kill из прошлого запуска сохраняется (вызывается до fork воркеров)"""
+        with self._header():
+            header = list(_HEADER.unpack_from(self.mm, 0))
+            if header[0] != _MAGIC or header[1] != self.capacity:
+                header = [_MAGIC, self.capacity, 0, 0, 0, 0.0, -1.0, -1.0, -1, -1, 0, 0]
+            header[2] = header[3] = 0  # count, version
+            header[4] += 1  # generation
+            self.mm[_HEADER_SIZE:] = bytes(self.size - _HEADER_SIZE)
+            _HEADER.pack_into(self.mm, 0, *header)
+        self.index, self._scanned = {}, 0
+
+    def populate(self, data: dict):
+        """Хосты из хранилища: {device_hash: line}"""
+        for device_hash, line in data.items():
+            self.put(device_hash, line[5], line[7])
+        logger.debug(f"[shared] {len(data)} hosts in {self.file}")
+
+    def _bump(self):
+        """Новая версия таблицы; вызывать под блокировкой записи"""
+        with self._header():
+            version = struct.unpack_from("<Q", self.mm, _VERSION)[0] + 1
+            struct.pack_into("<Q", self.mm, _VERSION, version)
+        return version
+
+    def scan(self):
+        """Дочитываем записи, добавленные другими воркерами"""
+        count = struct.unpack_from("<I", self.mm, _COUNT)[0]
+        for slot in range(self._scanned, count):
+            self.index[self.mm[self._offset(slot):self._offset(slot) + 32].hex()] = slot
+        self._scanned = max(self._scanned, count)
+
+    def find(self, device_hash):
+        slot = self.index.get(device_hash)
+        if slot is None:
+            self.scan()
+            slot = self.index.get(device_hash)
+        return slot
+
+    def _allocate(self, device_hash):
+        with self._header():
+            self.scan()  # Хост мог только что добавить другой воркер
+            slot = self.index.get(device_hash)
+            if slot is not None:
+                return slot
+            slot = struct.unpack_from("<I", self.mm, _COUNT)[0]
+            if slot >= self.capacity:
+                raise RuntimeError(f"Shared host table is full ({self.capacity} hosts)")
+            _RECORD.pack_into(self.mm, self._offset(slot), bytes.fromhex(device_hash), 0.0, 0, USED, 0, 0)
+            struct.pack_into("<I", self.mm, _COUNT, slot + 1)
+        self.index[device_hash] = slot
+        self._scanned = max(self._scanned, slot + 1)
+        return slot
+
+    def get(self, device_hash):
+        """(last_request, flags, revision) или None"""
+        slot = self.find(device_hash)
+        if slot is None:
+            return None
+        _, last_request, revision, flags, _, _ = _RECORD.unpack_from(self.mm, self._offset(slot))
+        return last_request, flags, revision
+
+    def put(self, device_hash, last_request, enable):
+        """Хост записан в хранилище: новая revision, другие воркеры перечитают его метаданные"""
+        slot = self.find(device_hash)
+        if slot is None:
+            slot = self._allocate(device_hash)
+        offset = self._offset(slot)
+        with self._record(slot):
+            raw, _, revision, flags, _, counter = _RECORD.unpack_from(self.mm, offset)
+            flags = (flags & (EXPECT_APP | EXPECT_ALL)) | USED | (ENABLE if enable else 0)
+            revision = (revision + 1) & 0xFFFFFFFF
+            _RECORD.pack_into(self.mm, offset, raw, last_request, revision, flags, self._bump(), counter)
+        return revision
+
+    def touch(self, device_hash, last_request):
+        slot = self.find(device_hash)
+        if slot is None:
+            return
+        offset = self._offset(slot)
+        with self._record(slot):
+            raw, _, revision, flags, _, counter = _RECORD.unpack_from(self.mm, offset)
+            _RECORD.pack_into(self.mm, offset, raw, last_request, revision, flags & ~INACTIVE, self._bump(), counter)
+
+    def remove(self, device_hash):
+        slot = self.find(device_hash)
+        if slot is None:
+            return
+        offset = self._offset(slot)
+        with self._record(slot):
+            raw, last_request, revision, flags, _, counter = _RECORD.unpack_from(self.mm, offset)
+            _RECORD.pack_into(self.mm, offset, raw, last_request, revision, flags | REMOVED, self._bump(), counter)
+
+    def mark_inactive(self, device_hash, before):
+        """Флаг неактивности ставит ровно один воркер: True - этот"""
+        slot = self.find(device_hash)
+        if slot is None:
+            return False
+        offset = self._offset(slot)
+        with self._record(slot):
+            raw, last_request, revision, flags, _, counter = _RECORD.unpack_from(self.mm, offset)
+            if flags & (INACTIVE | REMOVED) or not flags & ENABLE or last_request >= before:
+                return False
+            _RECORD.pack_into(self.mm, offset, raw, last_request, revision, flags | INACTIVE, self._bump(), counter)
+        return True
+
+    def advance_counter(self, device_hash, counter):
+        """Счетчик heartbeat хоста: True - counter новее принятого (и запомнен), False - повтор.
+        Неизвестный хост пропускаем - ответ UNKNOWN даст api"""
+        slot = self.find(device_hash)
+        if slot is None:
+            return True
+        offset = self._offset(slot)
+        with self._record(slot):
+            *fields, last = _RECORD.unpack_from(self.mm, offset)
+            if counter <= last:
+                return False
+            _RECORD.pack_into(self.mm, offset, *fields, counter)
+        return True
+
+    def changed(self, since):
+        """(версия, hash измененных, hash удаленных) после версии since"""
+        version = struct.unpack_from("<Q", self.mm, _VERSION)[0]
+        count = struct.unpack_from("<I", self.mm, _COUNT)[0]
+        changed, removed = [], []
+        for slot in range(count):
+            raw, _, _, flags, v, _ = _RECORD.unpack_from(self.mm, self._offset(slot))
+            if v > since:
+                (removed if flags & REMOVED else changed).append(raw.hex())
+        return version, changed, removed
+
+    # Состояние kill в заголовке
+
+    def generation(self):
+        return struct.unpack_from("<Q", self.mm, _GENERATION)[0]
+
+    def kill_state(self):
+        """(generation, started, acked, expected, pending)"""
+        with self._header():
+            _, _, _, _, generation, started, *rest = _HEADER.unpack_from(self.mm, 0)
+        acked, expected, pending = rest[0:2], rest[2:4], rest[4:6]
+        return generation, started, acked, expected, pending
+
+    def kill_request(self, started, app_hosts, all_hosts):
+        """Новый kill; app_hosts = None - без отслеживания подтверждений"""
+        with self._header():
+            header = list(_HEADER.unpack_from(self.mm, 0))
+            header[4] += 1
+            header[5] = started
+            if app_hosts is None:
+                header[6:12] = [-1.0, -1.0, -1, -1, 0, 0]
+            else:
+                counts = [len(app_hosts), len(all_hosts)]
+                header[6:12] = [-1.0 if n else 0.0 for n in counts] + counts + counts
+            _HEADER.pack_into(self.mm, 0, *header)
+        self.scan()
+        for device_hash, slot in self.index.items():
+            bits = 0
+            if app_hosts is not None:
+                bits = (EXPECT_APP if device_hash in app_hosts else 0) | (EXPECT_ALL if device_hash in all_hosts else 0)
+            offset = self._offset(slot)
+            with self._record(slot):
+                raw, last_request, revision, flags, version, counter = _RECORD.unpack_from(self.mm, offset)
+                _RECORD.pack_into(self.mm, offset, raw, last_request, revision,
+                                  (flags & ~(EXPECT_APP | EXPECT_ALL)) | bits, version, counter)
+
+    def ack(self, device_hash, now):
+        """Подтверждение от хоста; возвращает фазы, которые им завершились"""
+        slot = self.find(device_hash)
+        if slot is None:
+            return []
+        offset = self._offset(slot)
+        with self._record(slot):
+            raw, last_request, revision, flags, version, counter = _RECORD.unpack_from(self.mm, offset)
+            phases = [phase for phase, bit in enumerate(_EXPECT) if flags & bit]
+            if not phases:
+                return []
+            _RECORD.pack_into(self.mm, offset, raw, last_request, revision,
+                              flags & ~(EXPECT_APP | EXPECT_ALL), version, counter)
+        advanced = []
+        with self._header():
+            header = list(_HEADER.unpack_from(self.mm, 0))
+            for phase in phases:
+                header[10 + phase] -= 1
+                if header[10 + phase] <= 0 and header[6 + phase] < 0:
+                    header[6 + phase] = now - header[5]
+                    advanced.append(phase)
+            if advanced:
+                header[4] += 1
+            _HEADER.pack_into(self.mm, 0, *header)
+        return advanced
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class SharedDelays(Delays):
+    """Delays, состояние которого лежит в заголовке SharedTable и видно всем воркерам"""
+    poll = 0.25  # Как часто поток-наблюдатель проверяет generation в заголовке
+
+    def __init__(self, table, kill_first, kill_second):
+        super().__init__(kill_first, kill_second)
+        self.table = table
+        self._generation = None
+        self._pending_counts = [0, 0]
+        threading.Thread(target=self._watch, daemon=True, name="shared-delays").start()
+
+    def _watch(self):
+        """Чужой kill или ack сам локальных ждущих не разбудит. Заголовок опрашивает один поток на воркер
+        и будит всех сразу - сами ждущие спят до смены статуса по времени, сколько бы их ни было"""
+        seen = self.table.generation()  # Свое значение: _generation двигают и запросы через _sync
+        while True:
+            time.sleep(self.poll)
+            generation = self.table.generation()
+            if generation == seen:
+                continue
+            seen = generation
+            self._sync()
+            with self._changed:
+                self._changed.notify_all()
+            [listener() for listener in self.listeners]
+
+    def _sync(self):
+        """Перечитываем kill из заголовка, только если он поменялся"""
+        if self.table.generation() == self._generation:
+            return
+        with self._changed:
+            self._generation, started, acked, expected, pending = self.table.kill_state()
+            if not started:
+                self._started = None
+                self._first_end = self._second_end = float("-inf")
+                return
+            if not self.history or self.history[-1] != started:
+                self.history.append(started)
+            elapsed = max(0.0, datetime.now(timezone.utc).timestamp() - started)
+            self._started = time.monotonic() - elapsed
+            self._acked = [None if a < 0 else self._started + a for a in acked]
+            self._expected = expected
+            self._pending = [None if e < 0 else () for e in expected]
+            self._pending_counts = pending
+            self._recompute()
+
+    def _pending_count(self, phase):
+        return None if self._pending[phase] is None else self._pending_counts[phase]
+
+    def status(self) -> tuple[bool, bool]:
+        self._sync()
+        return super().status()
+
+    def next_change(self):
+        self._sync()
+        return super().next_change()
+
+    def report(self):
+        self._sync()
+        return super().report()
+
+    def kill_request(self, app_hosts=None, server_hosts=None):
+        all_hosts = None if app_hosts is None else set(app_hosts) | set(server_hosts or ())
+        self.table.kill_request(datetime.now(timezone.utc).timestamp(),
+                                None if app_hosts is None else set(app_hosts), all_hosts)
+        self._sync()
+        with self._changed:
+            self._changed.notify_all()
+        [listener() for listener in self.listeners]
+        logger.warning(f"Kill requested at {datetime.fromtimestamp(self.history[-1], timezone.utc)}")
+
+    def ack(self, device_hash):
+        advanced = self.table.ack(device_hash, datetime.now(timezone.utc).timestamp())
+        if not advanced:
+            return
+        self._sync()
+        with self._changed:
+            self._changed.notify_all()
+        [listener() for listener in self.listeners]
+        report = self.report()
+        for phase in advanced:
+            logger.warning(f"Kill phase {phase + 1} acknowledged by all {self._expected[phase]} hosts "
+                           f"in {report['phases'][phase]['seconds']}s")
+
+
+class SharedHostDatabase(HostDatabase):
+    """HostDatabase воркера: метаданные хостов в хранилище (SQLite), живость и версии - в SharedTable.
+    Истории переходов нет: каждый воркер видит только свою долю событий"""
+    keeps_history = False
+
+    def __init__(self, table, storage, flush_interval=30):
+        self.table = table
+        self._scheduled = {}  # hash: последний поставленный в очередь дедлайн
+        self._revisions = {}  # hash: revision записи, с которой загружены метаданные
+        super().__init__(storage, flush_interval)
+
+    def _read(self):
+        self.hosts = {}
+        for device_hash, line in self.storage.load().items():
+            r = self.table.get(device_hash)
+            host = Host.from_tuple(line)
+            if r is None or not self._refresh(host):
+                continue
+            self.hosts[device_hash] = host
+            self._revisions[device_hash] = r[2]
+            self._schedule(host)
+        logger.success(f"[datastore] Loaded {len(self.hosts)} hosts")
+
+    def record(self, device_hash, event, ts=None):
+        pass
+
+    def _load(self, device_hash):
+        """Хост из хранилища: зарегистрирован или изменен (update) в другом воркере"""
+        r = self.table.get(device_hash)
+        if r is None:
+            return None
+        # revision читаем до хранилища: гонка с записью даст лишнее перечитывание, а не старые данные
+        line = self.storage.get(device_hash)
+        if line is None:
+            return None
+        host = Host.from_tuple(line)
+        if not self._refresh(host):
+            return None
+        self.hosts[device_hash] = host
+        self._revisions[device_hash] = r[2]
+        self._schedule(host)
+        return host
+
+    def _refresh(self, host):
+        """Время пинга и enable из общей таблицы; False - хоста там нет или он удален"""
+        r = self.table.get(host.device_hash)
+        if r is None:
+            return False
+        last_request, flags, _ = r
+        if flags & REMOVED:
+            return False
+        host.last_request = datetime.fromtimestamp(last_request, timezone.utc)
+        host.enable = bool(flags & ENABLE)
+        return True
+
+    def _schedule(self, host):
+        super()._schedule(host)
+        self._scheduled[host.device_hash] = host.last_request.timestamp() + Host.inactive_timeout.total_seconds()
+
+    def _pop_expired(self, now):
+        expired = []
+        timeout = Host.inactive_timeout.total_seconds()
+        with self._wakeup:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, device_hash = heapq.heappop(self._deadlines)
+                if deadline < self._scheduled.get(device_hash, deadline):
+                    continue  # В очереди есть более поздний дедлайн
+                host = self.hosts.get(device_hash)
+                if host is None or not self._refresh(host) or not host.enable:
+                    continue
+                deadline = host.last_request.timestamp() + timeout
+                if deadline > now:
+                    # Хост пинговался в другом воркере
+                    self._scheduled[device_hash] = deadline
+                    heapq.heappush(self._deadlines, (deadline, device_hash))
+                    continue
+                if self.table.mark_inactive(device_hash, now - timeout):
+                    self._inactive.add(device_hash)
+                    expired.append(host)
+        return expired
+
+    def _changed(self, device_hash, removed=False):
+        # Версии живут в общей таблице: put/touch/mark_inactive увеличивают их сами
+        if removed:
+            self.table.remove(device_hash)
+            self._revisions.pop(device_hash, None)
+
+    def changes(self, since=None):
+        version, changed, removed = self.table.changed(since or 0)
+        if since is None or since > version:
+            return version, self.all(), [], True
+        return version, list(filter(None, map(self.get, changed))), removed, False
+
+    def _set(self, host: Host):
+        self.hosts[host.device_hash] = host
+        self.liveness.discard(host.device_hash)
+        self.storage.set(host.device_hash, host.to_tuple())
+        self._revisions[host.device_hash] = self.table.put(host.device_hash, host.last_request.timestamp(),
+                                                           host.enable)
+        self._schedule(host)
+
+    def touch(self, host: Host):
+        if host.device_hash not in self.hosts:
+            return
+        with self._lock:
+            self.liveness.add(host.device_hash)
+        self.table.touch(host.device_hash, host.last_request.timestamp())
+        self._schedule(host)
+
+    def get(self, device_hash):
+        host = self.hosts.get(device_hash)
+        r = self.table.get(device_hash)
+        if host is None or (r is not None and r[2] != self._revisions.get(device_hash)):
+            # Хост зарегистрировался или изменился в другом воркере
+            host = self._load(device_hash)
+            if host is None:
+                self.hosts.pop(device_hash, None)
+            return host
+        if not self._refresh(host):
+            self.hosts.pop(device_hash, None)
+            return None
+        return host
+
+    def known(self, device_hash):
+        # Без _refresh: объект хоста может нести еще не сохраненные изменения
+        r = self.table.get(device_hash)
+        return r is not None and not r[1] & REMOVED
+
+    def all(self, _asdict=False):
+        self.table.scan()
+        for device_hash in list(self.table.index):
+            self.get(device_hash)
+        return super().all(_asdict)
+
+
+class SharedHeartbeat(Heartbeat):
+    """Heartbeat воркера: датаграммы одного хоста попадают в разные воркеры,
+    поэтому последний принятый счетчик хранится в SharedTable"""
+
+    def __init__(self, table, api, secret, sock):
+        super().__init__(api, secret, sock)
+        self.table = table
+
+    def _fresh(self, device_hash, counter):
+        # Проверка и запись одной операцией: повтор не пройдет и через соседний воркер
+        return self.table.advance_counter(device_hash, counter)
+
+    def _accept(self, device_hash, counter):
+        pass
@@ -0,0 +1,92 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+from loguru import logger
+
+from .storage import Storage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    device_hash TEXT PRIMARY KEY,
+    hostname TEXT NOT NULL,
+    ips TEXT NOT NULL,
+    macs TEXT NOT NULL,
+    server INTEGER NOT NULL,
+    last_request INTEGER NOT NULL,
+    last_update INTEGER NOT NULL,
+    enable INTEGER NOT NULL
+);
+"""
+# Запросы - константы: sqlite3 держит их подготовленными в кеше соединения
+_SELECT_ALL = "SELECT hostname, device_hash, ips, macs, server, last_request, last_update, enable FROM hosts"
+_UPSERT = ("INSERT OR REPLACE INTO hosts (hostname, device_hash, ips, macs, server, last_request, last_update, enable) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+_SELECT_ONE = _SELECT_ALL + " WHERE device_hash = ?"
+_DELETE = "DELETE FROM hosts WHERE device_hash = ?"
+_TOUCH = "UPDATE hosts SET last_request = MAX(last_request, ?) WHERE device_hash = ?"  # Не раньше, чем уже записано
+_COUNT = "SELECT COUNT(*) FROM hosts"
+
+
+class SQLite(Storage):
+    """Хранилище хостов в SQLite (WAL): запись построчно, чтение по первичному ключу device_hash.
+    Вторичных индексов нет намеренно: неактивных ищет куча дедлайнов, списки строятся из памяти,
+    а индекс по last_request перестраивался бы на каждом сбросе пингов"""
+
+    def __init__(self, file):
+        self.file = Path(file)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.file, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    @staticmethod
+    def _row(line):
+        hostname, device_hash, ips, macs, server, last_request, last_update, enable = line
+        return hostname, device_hash, json.dumps(ips), json.dumps(macs), server, last_request, last_update, enable
+
+    def empty(self):
+        with self._lock:
+            return self._db.execute(_COUNT).fetchone()[0] == 0
+
+    def load(self) -> dict:
+        with self._lock:
+            rows = self._db.execute(_SELECT_ALL).fetchall()
+        data = {}
+        for hostname, device_hash, ips, macs, server, last_request, last_update, enable in rows:
+            data[device_hash] = (hostname, device_hash, json.loads(ips), json.loads(macs),
+                                 bool(server), last_request, last_update, bool(enable))
+        logger.debug(f"[sqlite] Loaded {len(data)} hosts from {self.file}")
+        return data
+
+    def get(self, device_hash):
+        with self._lock:
+            row = self._db.execute(_SELECT_ONE, (device_hash,)).fetchone()
+        if row is None:
+            return None
+        hostname, device_hash, ips, macs, server, last_request, last_update, enable = row
+        return hostname, device_hash, json.loads(ips), json.loads(macs), bool(server), last_request, last_update, bool(enable)
+
+    def import_all(self, data: dict):
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(_UPSERT, map(self._row, data.values()))
+
+    def set(self, device_hash, line):
+        with self._lock:
+            self._db.execute(_UPSERT, self._row(line))
+
+    def delete(self, device_hash):
+        with self._lock:
+            self._db.execute(_DELETE, (device_hash,))
+
+    def touch(self, pings: dict):
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(_TOUCH, ((last_request, device_hash) for device_hash, last_request in pings.items()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,67 @@
+import os
+
+from loguru import logger
+
+
+class Storage:
+    """Интерфейс хранилища хостов за HostDatabase; строки хостов - кортежи Host.to_tuple()"""
+    snapshots = False  # Нужна ли периодическая запись полного снапшота (rotate + write_snapshot)
+
+    def load(self) -> dict:
+        """Все хосты: {device_hash: line}"""
+        raise NotImplementedError
+
+    def get(self, device_hash):
+        """Строка одного хоста или None"""
+        return self.load().get(device_hash)
+
+    def set(self, device_hash, line):
+        raise NotImplementedError
+
+    def delete(self, device_hash):
+        raise NotImplementedError
+
+    def touch(self, pings: dict):
+        """Пачка пингов: {device_hash: last_request}"""
+        raise NotImplementedError
+
+    def need_compact(self):
+        return False
+
+    def rotate(self):
+        pass
+
+    def write_snapshot(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_storage(storage):
+    """Хранилище по секции storage конфига"""
+    from .journal import Journal
+    journal = Journal(storage.hosts, storage.journal, storage.compact_every)
+    match storage.backend:
+        case "journal":
+            return journal
+        case "sqlite":
+            from .sqlite import SQLite
+            db = SQLite(storage.sqlite)
+            if db.empty() and journal.snapshot_file.exists():
+                _migrate(journal, db)
+            return db
+        case _:
+            raise ValueError(f"Unknown storage backend: {storage.backend!r}")
+
+
+def _migrate(journal, db):
+    """Перенос hosts.json (+ журнал) в SQLite"""
+    data = journal.load()
+    journal.close()
+    db.import_all(data)
+    for file in (journal.journal_file, journal.rotated_file):
+        file.unlink(missing_ok=True)
+    migrated = journal.snapshot_file.with_name(journal.snapshot_file.name + ".migrated")
+    os.replace(journal.snapshot_file, migrated)
+    logger.success(f"[storage] Migrated {len(data)} hosts to {db.file}, old file kept as {migrated}")
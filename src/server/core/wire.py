@@ -0,0 +1,53 @@
+import gzip
+
+try:
+    import msgpack
+except ImportError:  # Без msgpack сервер просто всегда отвечает JSON
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+COMPRESS_MIN = 1024  # Меньшие ответы сжимать нет смысла
+_RAW = ("device_hash", "notice")  # В msgpack едут байтами: хеш - 32 байта вместо 64 символов hex
+
+
+def is_msgpack(content_type):
+    return msgpack is not None and (content_type or "").startswith(MSGPACK)
+
+
+def accepts(accept):
+    """Клиент сам просит msgpack в Accept - старые клиенты его не шлют и получают JSON"""
+    return msgpack is not None and MSGPACK in (accept or "")
+
+
+def _from_wire(obj):
+    if isinstance(obj, dict):
+        return {k: v.hex() if k in _RAW and isinstance(v, bytes) else _from_wire(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_from_wire(v) for v in obj]
+    return obj
+
+
+def _to_wire(obj):
+    if isinstance(obj, dict):
+        return {k: bytes.fromhex(v) if k in _RAW and isinstance(v, str) else _to_wire(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_wire(v) for v in obj]
+    return obj
+
+
+def unpack(body):
+    try:
+        return _from_wire(msgpack.unpackb(body, raw=False))
+    except (ValueError, msgpack.UnpackException) as e:
+        raise ValueError(f"bad msgpack: {e}") from e
+
+
+def pack(data):
+    return msgpack.packb(_to_wire(data), use_bin_type=True)
+
+
+def compress(body, accept_encoding):
+    """gzip тела ответа, если клиент его принимает и тело того стоит; иначе None"""
+    if len(body) < COMPRESS_MIN or "gzip" not in (accept_encoding or ""):
+        return None
+    return gzip.compress(body, 5)
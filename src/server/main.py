@@ -1,24 +1,64 @@
-import json
 import os
 import platform
-from datetime import timedelta, datetime
+import signal
+import socket
+import time
+from datetime import datetime
 
-from flask import Flask, request, render_template, redirect, url_for, make_response, flash
+from flask import Flask, Response, request, render_template, redirect, url_for, make_response, flash
 from loguru import logger
+from werkzeug.serving import make_server
 
-from core import InterceptHandler, HostDatabase, Host, config
+from core import InterceptHandler, HostDatabase, Api, Wait, get_error, open_storage, config, args, Dispatcher, Notify
+from core import wire, hot
+from core.sessions import SignedSessions
 
 app = Flask(__name__)
 app.secret_key = config.secret_key
 app.logger.addHandler(InterceptHandler())  # Эксепшены с фласка будут попадать в логи
-host_db = HostDatabase(config.storage.hosts)
-# Сначала убиваем все приложения, потом остальные
-#      web     |                            kill_app_timeout + kill_timeout                                |
-# -> kill_all -> kill_apps: true -kill_app_timeout-> kill_apps: false; kill_other: true -kill_serv_timeout-> kill_self
-delays = config.delays
-_cache = {
-    "login": []
-}
+host_db = delays = api = dispatcher = replicator = heartbeat = None  # Создаются в setup(): в режиме воркеров - уже после fork
+
+
+def setup(table=None, udp=None):
+    global host_db, delays, api, dispatcher, replicator, heartbeat
+    storage = open_storage(config.storage)
+    if config.replication.enabled:
+        from core.replication import Replicator, ReplicatedStorage
+        replicator = Replicator(config.replication)
+        storage = ReplicatedStorage(storage, replicator)
+    # Сначала убиваем все приложения, потом остальные
+    #      web     |                            kill_app_timeout + kill_timeout                                |
+    # -> kill_all -> kill_apps: true -kill_app_timeout-> kill_apps: false; kill_other: true -kill_serv_timeout-> kill_self
+    if table is None:
+        host_db = HostDatabase(storage, config.storage.flush_interval)
+        delays = config.delays
+    else:
+        from core.shared import SharedHostDatabase, SharedDelays
+        host_db = SharedHostDatabase(table, storage, config.storage.flush_interval)
+        delays = SharedDelays(table, config.delays.kill_first, config.delays.kill_second)
+    api = Api(host_db, delays, config)
+    if table is not None:
+        api.sessions = SignedSessions(config.secret_key, config.auth, config.server.session_ttl)
+    if replicator is not None:
+        replicator.attach(host_db, delays)
+        api.replicator = replicator
+    if config.heartbeat.enabled:
+        from core.heartbeat import Heartbeat, open_socket
+        if table is None:
+            heartbeat = Heartbeat(api, config.heartbeat.secret,
+                                  udp or open_socket(config.server.host, config.heartbeat.port))
+        else:
+            from core.shared import SharedHeartbeat
+            heartbeat = SharedHeartbeat(table, api, config.heartbeat.secret, udp)
+    # Уведомления отправляются в своем потоке, колбэки только кладут событие в очередь
+    dispatcher = Dispatcher([n for n in config.notify.values() if isinstance(n, Notify) and n.enabled],
+                            config.notify.window, config.notify.min_interval, config.notify.retries)
+    HostDatabase.inactive_callbacks.append(lambda host: dispatcher.push(host, "inactive", "timeout"))
+    HostDatabase.shutdown_callbacks.append(lambda host: dispatcher.push(host, "shutdown", "shutdown"))
+    HostDatabase.enable_callbacks.append(lambda host: dispatcher.push(host, "active", "ping"))
+    # Выключившиеся и пропавшие хосты подтверждают kill, фазы могут закончиться раньше таймаута
+    HostDatabase.shutdown_callbacks.append(lambda host: delays.ack(host.device_hash))
+    HostDatabase.inactive_callbacks.append(lambda host: delays.ack(host.device_hash))
 
 
 def kill_self():
@@ -34,113 +74,40 @@ def kill_self():
         os.system("shutdown -P now")
 
 
-def get_error(code, message=None, http_code=200, _add=None):
-    err = {"error": None, "code": code, "http_code": http_code}
-    match code:
-        case 1:
-            err['error'] = f"missing data: {message}"
-        case 2:
-            err['error'] = f"register first ({message})"
-        case 3:
-            err['error'] = "already registered"
-        case 4:
-            err['error'] = f"invalid data: {message}"
-        case 8:
-            err['error'] = f"external client error: {message}"
-        case 9:
-            err['error'] = f"internal server error: {message}"
-        case _:
-            err['error'] = f"unknown error ({message})"
-    if _add is not None:
-        err.update(_add)
-    return err
-
-
-def _get_host_info(act, data):
-    hostname, ips, macs, server = data.get('hostname'), data.get('ips'), data.get('macs'), data.get("server")
-    # Проверяем данные
-    if act in ("register", "update"):
-        if not all((hostname, ips, macs)):
-            return False, get_error(1, "hostname, ips, macs")
-        if not isinstance(hostname, str):
-            return False, get_error(4, "hostname must be a string")
-        if not isinstance(ips, list) or not isinstance(macs, list):
-            return False, get_error(4, "ips and macs must be lists")
-        if not isinstance(server, bool):
-            return False, get_error(4, "server must be a boolean")
-    return True, hostname, ips, macs, server
-
-
 def _check_cookie(need_flash=True):
-    auth = request.cookies.get('woraw'), request.cookies.get('wsolt')
-    if auth in _cache['login']:
+    if api.check_cookie(request.cookies.get('sid')):
         return True
     if need_flash:
-        logger.warning(f"Bad cookie from {request.remote_addr}")
+        hot.limited(("cookie", request.remote_addr), "WARNING", "Bad cookie from {}", request.remote_addr)
         flash("Bad cookie", "error")
     return False
 
 
 @app.route('/client', methods=['POST'])
 def client_update():
-    data = request.json
-    if isinstance(data, str):
-        data = json.loads(data)
-    device_hash = data.get('device_hash')  # Ожидаем, что клиент отправит свой уникальный хеш
-    act = data.get('act')  # Что хочет клиент
-    if act != "register":
-        if not all((device_hash, act)):
-            return get_error(1, "device_hash or act")
-        if len(device_hash) != 64:
-            return get_error(2, "bad device_hash")
-    _tmp = _get_host_info(act, data)
-    ok, host_info = _tmp[0], _tmp[1:]
-    if not ok:
-        return _tmp[1]  # Ошибка
-    match act:
-        case "register":  # Регистрируем новое устройство
-            host = Host(*host_info)
-            o = {"device_hash": host.device_hash}
-            if host.registered():
-                return get_error(3, _add=o)
-            host.save()
-            return o
-        case "update":  # раз в 12 часов обновляем данные от клиента
-            host = host_db.get(device_hash)
-            if host is None:
-                return get_error(2)
-            _device_hash = host.update(*host_info)
-            return {"device_hash": host.device_hash, "update_interval": config.client['update_interval'], "ping_interval": config.client['ping_interval']}
-        case "ping":  # раз в 1 минуту клиент шлет пинг
-            host = host_db.get(device_hash)
-            if host is None:
-                return get_error(4, "unknown device")
-            host.ping()
-            return {"message": "pong", "status": delays.status()}
-        case "shutdown":  # клиент завершает работу
-            host = host_db.get(device_hash)
-            if host is None:
-                return get_error(4, "unknown device")
-            host.shutdown()
-            return {"message": 0}
-        case _:
-            return get_error(4, "act")
+    if wire.is_msgpack(request.content_type):
+        try:
+            data = wire.unpack(request.get_data())
+        except ValueError as e:
+            return get_error(8, str(e), 400), 400
+    else:
+        data = request.json
+    r = api.client(data)
+    if isinstance(r, Wait):
+        r = r.result(delays.wait_change(r.status, r.timeout))
+    if wire.accepts(request.headers.get('Accept')):
+        return Response(wire.pack(r), mimetype=wire.MSGPACK)
+    return r
 
 
 # Обработка данных после отправки формы
 @app.route('/admin', methods=['POST'])
 def login():
-    user = None
-    auth = request.form.get('username'), request.form.get('password')
-    for i in config.auth:
-        if i == auth:
-            user = i
-    if user is not None:
+    session = api.login(request.form.get('username'), request.form.get('password'))
+    if session is not None:
         logger.success(f"Admin logged in from {request.remote_addr}")
         response = make_response(redirect(url_for('admin_dashboard')))
-        response.set_cookie('woraw', user.woraw, max_age=timedelta(hours=1))
-        response.set_cookie('wsolt', user.wsolt, max_age=timedelta(hours=1))
-        _cache['login'].append((user.woraw, user.wsolt))
+        response.set_cookie('sid', session, max_age=api.sessions.ttl, httponly=True)
         return response
     else:
         logger.warning(f"Invalid login or password from {request.remote_addr}")
@@ -172,13 +139,48 @@ def admin_dashboard():
 def admin_api(method):
     if not _check_cookie():
         return get_error(4, "invalid cookie"), 403
-    match method:
-        case "kill_all":
-            logger.info(f"Kill all command received from {request.remote_addr}")
-            delays.kill_request()
-            return {"message": "Command added to queue"}
-        case "updates":
-            return {"status": delays.status(), "hosts": host_db.all(True)}
+    return api.admin(method, request.remote_addr, request.get_json(silent=True))
+
+
+@app.route('/admin/api/stream', methods=['GET'])
+def admin_stream():
+    """SSE: дашборд получает изменения хостов по мере их появления"""
+    if not _check_cookie(False):
+        return get_error(4, "invalid cookie"), 403
+    since = request.args.get('since', type=int)
+
+    def events(since, status=None, idle=0):
+        while True:
+            event, since, status = api.stream_event(since, status)
+            if event is not None:
+                idle = 0
+                yield event
+            elif idle >= 15:
+                idle = 0
+                yield ": keepalive\n\n"
+            idle += 1
+            time.sleep(1)
+
+    return Response(events(since), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.route('/replication', methods=['POST'])
+def replication():
+    if replicator is None or not replicator.check_secret(request.headers.get('X-Killer-Secret')):
+        return get_error(4, "replication"), 403
+    return replicator.handle(request.get_json(silent=True))
+
+
+@app.after_request
+def compress_admin_api(response):
+    """Ответы админского API сжимаем: список хостов в JSON хорошо жмется"""
+    if request.path.startswith('/admin/api/') and response.status_code == 200 and not response.is_streamed:
+        body = wire.compress(response.get_data(), request.headers.get('Accept-Encoding'))
+        if body is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.errorhandler(Exception)
@@ -190,15 +192,92 @@ def handle_error(error):
         code = 8
     if status_code == 500:
         logger.exception(error)
+        return get_error(code, str(error), status_code, {"retry_after": config.client.retry_after}), status_code
     return get_error(code, str(error), status_code), status_code
 
 
-if __name__ == '__main__':
+def serve(sock=None):
     # Запускаем фоновую задачу проверки клиентов
     try:
+        dispatcher.start()
         host_db.start_checking()
-        app.run(host='0.0.0.0', port=5000)
+        if replicator is not None:
+            replicator.start()
+        if heartbeat is not None:
+            heartbeat.start()
+        if (args.mode or config.server.mode) == "asyncio":
+            from core.aserver import AsyncServer
+            AsyncServer(api, os.path.join(app.root_path, app.template_folder)).run(config.server.host, config.server.port, sock)
+        elif sock is None:
+            app.run(host=config.server.host, port=config.server.port)
+        else:
+            make_server(config.server.host, config.server.port, app, threaded=True, fd=sock.fileno()).serve_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        if heartbeat is not None:
+            heartbeat.stop()
+        if replicator is not None:
+            replicator.stop()
         host_db.stop_checking()
+        dispatcher.stop()
+        hot.flush()
+
+
+def _stop_worker(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def run_workers(workers):
+    """Prefork: общий сокет и общая таблица хостов, каждый воркер - отдельный процесс со своим GIL"""
+    from core.shared import SharedTable
+    if config.storage.backend != "sqlite":
+        logger.error("server.workers > 1 requires storage.backend = sqlite")
+        return
+    if config.replication.enabled:
+        logger.error("server.workers > 1 can't be used with replication")
+        return
+    table = SharedTable(config.storage.shared, config.storage.shared_capacity)
+    storage = open_storage(config.storage)
+    table.reset()
+    table.populate(storage.load())
+    storage.close()
+    sock = socket.create_server((config.server.host, config.server.port), backlog=4096)
+    udp = None
+    if config.heartbeat.enabled:
+        from core.heartbeat import open_socket
+        udp = open_socket(config.server.host, config.heartbeat.port)  # Один сокет на всех, датаграммы делит ядро
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)  # Ctrl+C получает только главный процесс, воркерам он передает SIGTERM
+            signal.signal(signal.SIGTERM, _stop_worker)
+            setup(table, udp)
+            serve(sock)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os._exit(0)
+        pids.append(pid)
+    logger.info(f"Started {workers} workers on {config.server.host}:{config.server.port}: {pids}")
+    signal.signal(signal.SIGTERM, _stop_worker)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+    table.close()
+
+
+if __name__ == '__main__':
+    if config.server.workers > 1:
+        run_workers(config.server.workers)
+    else:
+        setup()
+        serve()